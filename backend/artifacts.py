@@ -0,0 +1,176 @@
+"""
+Per-job artifact storage.
+
+Every generation job writes its battle JSON and images into its own
+directory, so concurrent jobs never overwrite each other's files. Files are
+written to a temporary name and renamed into place, and each finished job
+gets a manifest.json that maps its artifacts to the URLs the frontend loads.
+Old job directories are garbage collected by age and count.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import metrics
+
+# Load environment variables
+load_dotenv()
+
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "./public/jobs")
+# URL the frontend uses for ARTIFACT_DIR (Next.js serves ./public at /)
+ARTIFACT_URL_PREFIX = os.getenv("ARTIFACT_URL_PREFIX", "/jobs")
+ARTIFACT_MAX_JOBS = int(os.getenv("ARTIFACT_MAX_JOBS", "200"))
+ARTIFACT_MAX_AGE = float(os.getenv("ARTIFACT_MAX_AGE", str(24 * 3600)))
+
+MANIFEST_NAME = "manifest.json"
+
+
+def _tmp_path(path):
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def atomic_write_bytes(path, data):
+    """Writes data to path so readers only ever see the complete file."""
+    with metrics.span("file_write") as span:
+        tmp_path = _tmp_path(path)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        span.set_size(len(data))
+    return path
+
+
+def atomic_write_json(path, data, **kwargs):
+    with metrics.span("file_write") as span:
+        tmp_path = _tmp_path(path)
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, **kwargs)
+            span.set_size(f.tell())
+        os.replace(tmp_path, path)
+    return path
+
+
+def atomic_save_image(image, path, format="PNG", **options):
+    with metrics.span("file_write") as span:
+        tmp_path = _tmp_path(path)
+        image.save(tmp_path, format=format, **options)
+        span.set_size(os.path.getsize(tmp_path))
+        os.replace(tmp_path, path)
+    return path
+
+
+def atomic_copy(src, dst):
+    with metrics.span("file_write") as span:
+        tmp_path = _tmp_path(dst)
+        shutil.copyfile(src, tmp_path)
+        span.set_size(os.path.getsize(tmp_path))
+        os.replace(tmp_path, dst)
+    return dst
+
+
+class ArtifactStore:
+    """
+    Directory per job under root, plus a manifest per job.
+
+    Args:
+        root (str): Directory holding one sub-directory per job (default: ARTIFACT_DIR)
+        url_prefix (str): URL path under which root is served (default: ARTIFACT_URL_PREFIX)
+        max_jobs (int): Job directories kept by gc()
+        max_age (float): Seconds after which gc() removes a job directory
+    """
+
+    def __init__(self, root=None, url_prefix=None, max_jobs=None, max_age=None):
+        self.root = root or ARTIFACT_DIR
+        self.url_prefix = (url_prefix if url_prefix is not None else ARTIFACT_URL_PREFIX).rstrip("/")
+        self.max_jobs = max_jobs or ARTIFACT_MAX_JOBS
+        self.max_age = ARTIFACT_MAX_AGE if max_age is None else max_age
+
+    def job_dir(self, job_id, create=True):
+        if not job_id or os.sep in job_id or job_id.startswith("."):
+            raise ValueError(f"Invalid job id: {job_id!r}")
+        path = os.path.join(self.root, job_id)
+        if create:
+            os.makedirs(path, exist_ok=True)
+        return path
+
+    def url_for(self, job_id, path):
+        return f"{self.url_prefix}/{job_id}/{os.path.basename(path)}"
+
+    def write_manifest(self, job_id, files, **extra):
+        """
+        Writes manifest.json for a job
+
+        Args:
+            job_id (str): The job id
+            files (dict): Artifact name to file path
+            **extra: Additional fields stored in the manifest (e.g. topic)
+
+        Returns:
+            dict: The manifest
+        """
+        manifest = {
+            "job_id": job_id,
+            "created_at": time.time(),
+            **extra,
+            "files": {name: self.url_for(job_id, path) for name, path in files.items()},
+        }
+        atomic_write_json(os.path.join(self.job_dir(job_id), MANIFEST_NAME), manifest)
+        return manifest
+
+    def read_manifest(self, job_id):
+        """Returns the manifest of a job, or None if it has none (yet)."""
+        try:
+            with open(os.path.join(self.job_dir(job_id, create=False), MANIFEST_NAME)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def gc(self):
+        """
+        Removes job directories older than max_age, then the oldest ones
+        beyond max_jobs
+
+        Returns:
+            int: Number of job directories removed
+        """
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return 0
+
+        dirs = []
+        for name in names:
+            path = os.path.join(self.root, name)
+            try:
+                if os.path.isdir(path):
+                    dirs.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        dirs.sort(reverse=True)
+
+        now = time.time()
+        removed = 0
+        for index, (mtime, path) in enumerate(dirs):
+            if index >= self.max_jobs or now - mtime > self.max_age:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        return removed
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Returns the process-wide ArtifactStore."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ArtifactStore()
+    return _store
@@ -0,0 +1,170 @@
+"""
+In-memory cache of generated battle JSON, keyed by normalized topic.
+
+A Maestro run is the slowest and most expensive step of the pipeline, so a
+topic asked for again within BATTLE_CACHE_TTL seconds reuses the earlier
+battle. Concurrent requests for the same topic are coalesced onto a single
+in-flight run.
+"""
+
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+BATTLE_CACHE_TTL = float(os.getenv("BATTLE_CACHE_TTL", "3600"))
+BATTLE_CACHE_MAX_ENTRIES = int(os.getenv("BATTLE_CACHE_MAX_ENTRIES", "256"))
+
+
+def normalize_topic(topic):
+    return " ".join(str(topic).lower().split())
+
+
+class _Flight:
+    """A computation in progress that other callers can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BattleCache:
+    """
+    TTL + LRU cache with request coalescing.
+
+    Args:
+        ttl (float): Seconds an entry stays valid (default: BATTLE_CACHE_TTL)
+        max_entries (int): Entries kept before the least recently used is dropped
+    """
+
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = BATTLE_CACHE_TTL if ttl is None else ttl
+        self.max_entries = max_entries or BATTLE_CACHE_MAX_ENTRIES
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        # Caller must hold the lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, battle = entry
+        if time.time() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return battle
+
+    def get(self, topic):
+        """Returns a copy of the cached battle for topic, or None."""
+        with self._lock:
+            battle = self._lookup(normalize_topic(topic))
+            if battle is not None:
+                self.hits += 1
+        return copy.deepcopy(battle)
+
+    def put(self, topic, battle):
+        with self._lock:
+            self._store(normalize_topic(topic), battle)
+
+    def _store(self, key, battle):
+        # Caller must hold the lock
+        self._entries[key] = (time.time(), copy.deepcopy(battle))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, topic):
+        with self._lock:
+            self._entries.pop(normalize_topic(topic), None)
+
+    def get_or_compute(self, topic, compute, refresh=False):
+        """
+        Returns the battle for topic, running compute() only when needed
+
+        If another thread is already computing the same topic, this call
+        waits for that result instead of starting a second run.
+
+        Args:
+            topic (str): The battle topic
+            compute (callable): Produces the battle data for a miss
+            refresh (bool): Ignore any cached entry and compute a fresh one
+
+        Returns:
+            tuple: (battle, cached) where cached tells if it came from the cache
+        """
+        key = normalize_topic(topic)
+        with self._lock:
+            if not refresh:
+                battle = self._lookup(key)
+                if battle is not None:
+                    self.hits += 1
+                    return copy.deepcopy(battle), True
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.result), False
+
+        try:
+            flight.result = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            with self._lock:
+                self._store(key, flight.result)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.done.set()
+        return copy.deepcopy(flight.result), False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "in_flight": len(self._inflight),
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Returns the process-wide BattleCache."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = BattleCache()
+    return _cache
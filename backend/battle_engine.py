@@ -0,0 +1,257 @@
+"""
+Local, deterministic combat engine.
+
+Resolves battle rounds from the structured move data instead of asking an
+LLM for damage numbers. Each move's description is mapped to a status
+effect by keyword, and all randomness comes from a seeded random.Random, so
+a battle replays identically from the same seed. The result of a round has
+the same keys the LLM battle prompt asks for, so an LLM can still narrate it.
+"""
+
+import random
+
+MOVE_KEYS = ['move_1', 'move_2', 'move_3', 'move_4']
+
+# Effect name -> words in a move description that trigger it
+EFFECT_KEYWORDS = {
+    'stun': ('stun', 'paraly', 'freez', 'disarm', 'immobil', 'knock'),
+    'confuse': ('confus', 'accuracy', 'blind', 'distract', 'dizz'),
+    'evade': ('evasion', 'evade', 'dodge', 'speed', 'agility'),
+    'shield': ('absorb', 'protect', 'shield', 'block', 'barrier', 'defen'),
+    'heal': ('heal', 'restor', 'recover', 'regenerat'),
+    'bleed': ('burn', 'poison', 'bleed', 'wound', 'toxic'),
+    'weaken': ('weaken', 'limit', 'lower', 'reduc', 'intimidat'),
+}
+
+BASE_MISS_CHANCE = 0.05
+EFFECTIVENESS_MEAN = 100
+EFFECTIVENESS_SPREAD = 35
+# How many rounds each effect lasts on its target
+EFFECT_DURATION = {'stun': 1, 'confuse': 2, 'evade': 1, 'shield': 1, 'bleed': 2, 'weaken': 1}
+
+
+def effect_for(description):
+    """Returns the status effect a move description maps to, or None."""
+    text = str(description).lower()
+    for effect, keywords in EFFECT_KEYWORDS.items():
+        if any(keyword in text for keyword in keywords):
+            return effect
+    return None
+
+
+def to_int(value, default=0):
+    try:
+        return int(float(str(value).strip()))
+    except (TypeError, ValueError):
+        return default
+
+
+class Move:
+    def __init__(self, name, description, damage):
+        self.name = name
+        self.description = description
+        self.damage = damage
+        self.effect = effect_for(description)
+
+
+class Fighter:
+    def __init__(self, name, hp, moves, persona=''):
+        self.name = name
+        self.hp = hp
+        self.max_hp = hp
+        self.persona = persona
+        self.moves = moves
+        # Effect name -> rounds left
+        self.effects = {}
+
+    @property
+    def alive(self):
+        return self.hp > 0
+
+
+def fighter_from_player(player):
+    """Builds a Fighter from the player dicts used by gen_chat_prompt."""
+    moves = [Move(player[key]['name'], player[key]['description'], to_int(player[key]['dmg']))
+             for key in MOVE_KEYS]
+    return Fighter(player['name'], to_int(player['hp']), moves, player.get('persona', ''))
+
+
+def fighter_from_character(character, default_hp=300):
+    """Builds a Fighter from a Character_N entry of a generated battle JSON."""
+    moves = []
+    for i in range(1, 5):
+        move = character['Moves'][f'Move_{i}']
+        moves.append(Move(move.get('Move_name', f'Move {i}'), move.get('Description', ''),
+                          to_int(move.get('Damage'))))
+    hp = to_int(character.get('HP'), default_hp) or default_hp
+    return Fighter(character.get('Name', 'Unknown Character'), hp, moves,
+                   character.get('Character_Summary', ''))
+
+
+class BattleEngine:
+    """
+    Resolves rounds between two fighters.
+
+    Args:
+        fighter_1 (Fighter): Player1
+        fighter_2 (Fighter): Player2
+        seed (int): Seed for the engine's random generator
+    """
+
+    def __init__(self, fighter_1, fighter_2, seed=None):
+        self.fighters = (fighter_1, fighter_2)
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.round_number = 0
+
+    @property
+    def both_alive(self):
+        return all(fighter.alive for fighter in self.fighters)
+
+    def random_move(self):
+        """Picks a move key the same way the battle loop does."""
+        return self.rng.choice(MOVE_KEYS)
+
+    def _move(self, fighter, move_key):
+        index = MOVE_KEYS.index(move_key) if isinstance(move_key, str) else move_key
+        return fighter.moves[index]
+
+    def _effectiveness(self, attacker, defender):
+        miss_chance = BASE_MISS_CHANCE
+        if 'confuse' in attacker.effects:
+            miss_chance += 0.25
+        if 'evade' in defender.effects:
+            miss_chance += 0.2
+        if self.rng.random() < miss_chance:
+            return 0
+        effectiveness = self.rng.gauss(EFFECTIVENESS_MEAN, EFFECTIVENESS_SPREAD)
+        if 'stun' in attacker.effects:
+            effectiveness *= 0.5
+        return int(min(200, max(0, round(effectiveness))))
+
+    def _damage(self, move, effectiveness, attacker, defender):
+        damage = move.damage * effectiveness / 100
+        if 'weaken' in attacker.effects:
+            damage *= 0.75
+        if 'shield' in defender.effects:
+            damage *= 0.5
+        return int(round(damage))
+
+    def _tick(self, fighter):
+        # Damage over time, then count down every effect by one round
+        bleed = fighter.effects.get('bleed_damage', 0) if 'bleed' in fighter.effects else 0
+        fighter.hp -= bleed
+        for effect in list(fighter.effects):
+            if effect in EFFECT_DURATION:
+                fighter.effects[effect] -= 1
+                if fighter.effects[effect] <= 0:
+                    del fighter.effects[effect]
+                    fighter.effects.pop(f'{effect}_damage', None)
+        return bleed
+
+    def _apply(self, move, effectiveness, attacker, defender, damage):
+        if move.effect is None or effectiveness == 0:
+            return
+        if move.effect in ('evade', 'shield'):
+            # Self buffs protect against the next round's attack
+            attacker.effects[move.effect] = EFFECT_DURATION[move.effect]
+        elif move.effect == 'heal':
+            attacker.hp = min(attacker.max_hp, attacker.hp + damage // 2)
+        elif move.effect == 'bleed':
+            defender.effects['bleed'] = EFFECT_DURATION['bleed']
+            defender.effects['bleed_damage'] = max(1, move.damage // 5)
+        else:
+            defender.effects[move.effect] = EFFECT_DURATION[move.effect]
+
+    def resolve_round(self, move_key_1, move_key_2):
+        """
+        Resolves one round where both players attack at the same time
+
+        Args:
+            move_key_1: Player1's move, 'move_1'..'move_4' or an index 0-3
+            move_key_2: Player2's move
+
+        Returns:
+            dict: effectiveness_N, damage_N, narrative_N and summary, as in the
+            LLM battle prompt, plus the players' HP after the round
+        """
+        p1, p2 = self.fighters
+        self.round_number += 1
+        move_1 = self._move(p1, move_key_1)
+        move_2 = self._move(p2, move_key_2)
+
+        effectiveness_1 = self._effectiveness(p1, p2)
+        effectiveness_2 = self._effectiveness(p2, p1)
+        damage_1 = self._damage(move_1, effectiveness_1, p1, p2)
+        damage_2 = self._damage(move_2, effectiveness_2, p2, p1)
+
+        bleed_1 = self._tick(p1)
+        bleed_2 = self._tick(p2)
+        p2.hp -= damage_1
+        p1.hp -= damage_2
+        self._apply(move_1, effectiveness_1, p1, p2, damage_1)
+        self._apply(move_2, effectiveness_2, p2, p1, damage_2)
+
+        return {
+            'round': self.round_number,
+            'move_1': move_1.name,
+            'effectiveness_1': effectiveness_1,
+            'damage_1': damage_1,
+            'narrative_1': self._describe(p1, move_1, effectiveness_1, damage_1, p2),
+            'move_2': move_2.name,
+            'effectiveness_2': effectiveness_2,
+            'damage_2': damage_2,
+            'narrative_2': self._describe(p2, move_2, effectiveness_2, damage_2, p1),
+            'summary': self._summary(bleed_1, bleed_2),
+            'hp_1': p1.hp,
+            'hp_2': p2.hp,
+        }
+
+    def _describe(self, attacker, move, effectiveness, damage, defender):
+        if effectiveness == 0:
+            return f"{attacker.name} used {move.name}, but it missed!"
+        text = f"{attacker.name} used {move.name} on {defender.name} for {damage} damage."
+        if effectiveness >= 150:
+            text += " It's super effective!"
+        elif effectiveness <= 50:
+            text += " It's not very effective..."
+        return text
+
+    def _summary(self, bleed_1, bleed_2):
+        parts = []
+        for fighter, bleed in zip(self.fighters, (bleed_1, bleed_2)):
+            if bleed:
+                parts.append(f"{fighter.name} took {bleed} lingering damage.")
+            active = sorted(effect for effect in fighter.effects if effect in EFFECT_DURATION)
+            if active:
+                parts.append(f"{fighter.name} is affected by: {', '.join(active)}.")
+        return ' '.join(parts) or 'None'
+
+    def play(self, max_rounds=200, choose=None):
+        """
+        Plays random moves until a player is knocked out
+
+        Args:
+            max_rounds (int): Rounds after which the battle is called a tie
+            choose (callable): Optional choose(engine) -> (move_key_1, move_key_2)
+
+        Returns:
+            list: The result of every round
+        """
+        rounds = []
+        while self.both_alive and self.round_number < max_rounds:
+            if choose is not None:
+                move_key_1, move_key_2 = choose(self)
+            else:
+                move_key_1, move_key_2 = self.random_move(), self.random_move()
+            rounds.append(self.resolve_round(move_key_1, move_key_2))
+        return rounds
+
+    def winner(self):
+        """Returns the winning Fighter, or None for a tie or an unfinished battle."""
+        p1, p2 = self.fighters
+        if p1.alive and not p2.alive:
+            return p1
+        if p2.alive and not p1.alive:
+            return p2
+        return None
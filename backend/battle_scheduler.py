@@ -0,0 +1,226 @@
+"""
+Runs many battles concurrently in one process.
+
+Every battle is an asyncio task that plays its rounds one after another.
+Rounds that need the provider go through limits the scheduler shares
+between all its battles. A token bucket caps requests per second, and
+a semaphore caps how many are in flight. The blocking requests themselves
+run on a thread pool of that size.
+
+Both limits hand out their turns first come, first served, and a battle
+has at most one round waiting at a time. A battle whose round finishes goes
+to the back of the line, so hundreds of battles share the provider round
+robin and a long battle cannot starve the others. Local engine rounds
+are cheap and run on the event loop, yielding to the other battles after
+each round.
+
+    python battle_scheduler.py --battles 200 --engine local
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import metrics
+import providers
+from gen_chat_prompt import Battle
+
+# Load environment variables
+load_dotenv()
+
+# Provider round requests per second across all battles, 0 for no limit
+BATTLE_ROUND_RATE = float(os.getenv("BATTLE_ROUND_RATE", "10"))
+# Round requests in flight at once (default: the ai21 provider's limit)
+BATTLE_ROUND_CONCURRENCY = int(os.getenv("BATTLE_ROUND_CONCURRENCY", "0"))
+# Battles still going after this many rounds are stopped as a tie
+BATTLE_MAX_ROUNDS = int(os.getenv("BATTLE_MAX_ROUNDS", "100"))
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class RateLimiter:
+    """
+    Token bucket for asyncio tasks, serving waiters in arrival order.
+
+    Args:
+        rate (float): Tokens added per second, 0 for no limit
+        burst (int): Tokens the bucket holds at most
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = None
+        # asyncio.Lock wakes its waiters first come, first served
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self._updated is not None:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BattleScheduler:
+    """
+    Drives concurrent battles over shared provider limits.
+
+    start() and run() must be called from inside a running event loop.
+
+    Args:
+        rate (float): Round requests per second (default: BATTLE_ROUND_RATE)
+        concurrency (int): Round requests in flight (default:
+            BATTLE_ROUND_CONCURRENCY, or the ai21 provider limit)
+        max_rounds (int): Rounds before a battle is stopped (default: BATTLE_MAX_ROUNDS)
+        on_round (callable): Called as on_round(battle, round_json, out)
+            after each round, on the event loop
+    """
+
+    def __init__(self, rate=None, concurrency=None, max_rounds=None, on_round=None):
+        self.concurrency = concurrency or BATTLE_ROUND_CONCURRENCY or providers.concurrency_limit("ai21")
+        self.limiter = RateLimiter(BATTLE_ROUND_RATE if rate is None else rate, burst=self.concurrency)
+        self.max_rounds = max_rounds or BATTLE_MAX_ROUNDS
+        self.on_round = on_round
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="battle-round")
+        self.battles = {}
+        self.status = {}
+        self.errors = {}
+        self._tasks = {}
+        self._rounds = 0
+        self._started = time.perf_counter()
+
+    def start(self, battle):
+        """Schedules a battle and returns its task."""
+        self.battles[battle.id] = battle
+        self.status[battle.id] = PENDING
+        task = asyncio.get_running_loop().create_task(self._run(battle), name=f"battle-{battle.id}")
+        self._tasks[battle.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(battle.id, None))
+        return task
+
+    def cancel(self, battle_id):
+        """
+        Cancels a battle, returns False if it isn't running
+
+        A round request already sent finishes on its thread, but its result
+        is never applied to the battle.
+        """
+        task = self._tasks.get(battle_id)
+        if task is None:
+            return False
+        return task.cancel()
+
+    async def _play_round(self, battle):
+        if not battle.uses_provider:
+            result = battle.play_round()
+            # Let the other battles run between local rounds
+            await asyncio.sleep(0)
+            return result
+
+        await self.limiter.acquire()
+        async with self._semaphore:
+            if battle.engine != "llm":
+                # Narrated local rounds: the narration request is the slow part
+                return await asyncio.wrap_future(metrics.submit(self._executor, battle.play_round))
+            move_1, move_2 = battle.choose_moves()
+            with metrics.span("battle_round", engine=battle.engine):
+                round_json, out, usage = await asyncio.wrap_future(
+                    metrics.submit(self._executor, battle.resolve, move_1, move_2))
+        battle.apply(move_1, move_2, round_json, usage)
+        return round_json, out
+
+    async def _run(self, battle):
+        self.status[battle.id] = RUNNING
+        try:
+            while battle.both_alive and battle.round_number < self.max_rounds:
+                round_json, out = await self._play_round(battle)
+                self._rounds += 1
+                if self.on_round is not None:
+                    self.on_round(battle, round_json, out)
+        except asyncio.CancelledError:
+            self.status[battle.id] = CANCELLED
+            raise
+        except Exception as e:
+            self.status[battle.id] = FAILED
+            self.errors[battle.id] = f"{type(e).__name__}: {e}"
+            return battle
+        self.status[battle.id] = DONE
+        return battle
+
+    async def run(self, battles):
+        """
+        Plays battles to the end
+
+        Returns:
+            list: The battles, cancelled and failed ones included
+        """
+        tasks = [self.start(battle) for battle in battles]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return list(battles)
+
+    def stats(self):
+        counts = {}
+        for status in self.status.values():
+            counts[status] = counts.get(status, 0) + 1
+        elapsed = time.perf_counter() - self._started
+        return {
+            "battles": counts,
+            "rounds": self._rounds,
+            "rounds_per_second": round(self._rounds / elapsed, 2) if elapsed else 0.0,
+            "concurrency": self.concurrency,
+            "rate": self.limiter.rate,
+        }
+
+    def close(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def _main(args):
+    from gen_chat_prompt import p1, p2
+
+    scheduler = BattleScheduler(rate=args.rate, concurrency=args.concurrency)
+    battles = [Battle(p1, p2, engine=args.engine, narrate=args.narrate, seed=i) for i in range(args.battles)]
+    try:
+        await scheduler.run(battles)
+    finally:
+        scheduler.close()
+
+    winners = {}
+    for battle in battles:
+        winner = battle.winner or "tie"
+        winners[winner] = winners.get(winner, 0) + 1
+    print(f"Winners: {winners}")
+    print(f"Scheduler: {scheduler.stats()}")
+    for battle_id, error in list(scheduler.errors.items())[:5]:
+        print(f"  {battle_id}: {error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--battles", type=int, default=100, help="Battles between the example players")
+    parser.add_argument("--engine", choices=["local", "llm"], default="local")
+    parser.add_argument("--narrate", action="store_true", help="Have the LLM narrate local rounds")
+    parser.add_argument("--rate", type=float, default=None, help="Round requests per second")
+    parser.add_argument("--concurrency", type=int, default=None, help="Round requests in flight")
+    asyncio.run(_main(parser.parse_args()))
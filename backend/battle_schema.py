@@ -0,0 +1,280 @@
+"""
+Typed battle records and compact storage.
+
+Generated battles come in two shapes: web_search asks for "Character 1"
+with an HP field, web_search_maestro for "Character_1" without one, and
+both may write numbers as strings ("Damage": "40"). BattleRecord.from_dict()
+accepts either and produces slotted dataclasses with real numbers;
+to_dict() gives back the canonical "Character_1" shape.
+
+A single record serializes with dumps() to a positional row (no repeated key
+names): msgpack when it is installed, compact JSON otherwise. loads() reads
+either. Many records go into a columnar .npz archive with save_archive():
+HP and damage are plain integer arrays and all text is one UTF-8 blob with
+offsets, so scans over the numbers never decode a string.
+
+    python battle_schema.py pack battles.npz output/*/battle.json
+    python battle_schema.py info battles.npz
+"""
+
+import argparse
+import copy
+import json
+from dataclasses import dataclass
+from typing import Optional
+
+from json_extract import BATTLE_CHARACTER_KEYS, MOVE_KEYS, SchemaError, to_number, validate_battle
+
+# Stored for a missing HP in the archive's hp column, real HP is never negative
+NO_HP = -1
+# Range of the archive's int32 columns
+INT32_MIN = -2 ** 31
+INT32_MAX = 2 ** 31 - 1
+# Text fields per record in the archive: per character the name, summary and
+# the four move names and descriptions, then the background
+_TEXTS_PER_CHARACTER = 2 + 2 * len(MOVE_KEYS)
+_TEXTS_PER_RECORD = 2 * _TEXTS_PER_CHARACTER + 1
+
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        return None
+    return msgpack
+
+
+def _int(value, field, low=INT32_MIN, high=INT32_MAX):
+    value = to_number(value)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise SchemaError(f"{field} is not a whole number")
+    if not low <= value <= high:
+        raise SchemaError(f"{field} is out of range ({low} to {high})")
+    return value
+
+
+@dataclass(slots=True)
+class Move:
+    name: str
+    description: str
+    damage: int
+
+
+@dataclass(slots=True)
+class Character:
+    name: str
+    summary: str
+    moves: tuple
+    hp: Optional[int] = None
+
+    @classmethod
+    def from_dict(cls, data, key="Character"):
+        moves = tuple(Move(move["Move_name"], move["Description"], _int(move["Damage"], f"{key}.{move_key}.Damage"))
+                      for move_key, move in ((k, data["Moves"][k]) for k in MOVE_KEYS))
+        hp = data.get("HP")
+        return cls(data["Name"], data["Character_Summary"], moves,
+                   None if hp is None else _int(hp, f"{key}.HP", low=0))
+
+    def to_dict(self):
+        data = {"Name": self.name, "Character_Summary": self.summary}
+        if self.hp is not None:
+            data["HP"] = self.hp
+        data["Moves"] = {key: {"Move_name": move.name, "Description": move.description, "Damage": move.damage}
+                         for key, move in zip(MOVE_KEYS, self.moves)}
+        return data
+
+    def to_player(self, default_hp=300):
+        """The player dict gen_chat_prompt battles use."""
+        player = {"name": self.name, "persona": self.summary, "hp": self.hp or default_hp}
+        for i, move in enumerate(self.moves, 1):
+            player[f"move_{i}"] = {"name": move.name, "description": move.description, "dmg": move.damage}
+        return player
+
+    def to_row(self):
+        return [self.name, self.summary, self.hp, [[m.name, m.description, m.damage] for m in self.moves]]
+
+    @classmethod
+    def from_row(cls, row):
+        name, summary, hp, moves = row
+        return cls(name, summary, tuple(Move(*move) for move in moves), hp)
+
+
+@dataclass(slots=True)
+class BattleRecord:
+    character_1: Character
+    character_2: Character
+    background: str = ""
+
+    @property
+    def characters(self):
+        return self.character_1, self.character_2
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Builds a record from either battle shape
+
+        Raises:
+            SchemaError: If the battle doesn't match the schema
+        """
+        data = validate_battle(copy.deepcopy(data))
+        characters = [Character.from_dict(data[key], key) for key in BATTLE_CHARACTER_KEYS]
+        return cls(characters[0], characters[1], data.get("Background", ""))
+
+    def to_dict(self):
+        """The canonical "Character_1" battle dict, numbers as numbers."""
+        data = {key: character.to_dict() for key, character in zip(BATTLE_CHARACTER_KEYS, self.characters)}
+        data["Background"] = self.background
+        return data
+
+    def to_row(self):
+        return [self.character_1.to_row(), self.character_2.to_row(), self.background]
+
+    @classmethod
+    def from_row(cls, row):
+        character_1, character_2, background = row
+        return cls(Character.from_row(character_1), Character.from_row(character_2), background)
+
+
+def dumps(record):
+    """Serializes a record to bytes, msgpack if installed, compact JSON otherwise."""
+    msgpack = _msgpack()
+    if msgpack is not None:
+        return msgpack.packb(record.to_row(), use_bin_type=True)
+    return json.dumps(record.to_row(), separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def loads(data):
+    """Reads bytes written by dumps(), in either format."""
+    # A JSON row starts with "[", a msgpack array never does
+    if data[:1] == b"[":
+        return BattleRecord.from_row(json.loads(data))
+    msgpack = _msgpack()
+    if msgpack is None:
+        raise ValueError("Record is msgpack encoded, but msgpack is not installed")
+    return BattleRecord.from_row(msgpack.unpackb(data, raw=False))
+
+
+def load_battle_file(path):
+    """Reads a battle JSON file of either shape into a record."""
+    with open(path, encoding="utf-8") as f:
+        return BattleRecord.from_dict(json.load(f))
+
+
+def _texts(record):
+    texts = []
+    for character in record.characters:
+        texts.extend((character.name, character.summary))
+        for move in character.moves:
+            texts.extend((move.name, move.description))
+    texts.append(record.background)
+    return texts
+
+
+def save_archive(records, path):
+    """
+    Writes records to a columnar .npz archive
+
+    Columns:
+        hp: int32 (n, 2), NO_HP where the battle had none
+        damage: int32 (n, 2, 4)
+        text: uint8 UTF-8 blob of every text field
+        text_offsets: int64 (n * texts per record + 1) offsets into text
+
+    Returns:
+        str: The path
+    """
+    import numpy as np
+
+    records = list(records)
+    hp = np.full((len(records), 2), NO_HP, dtype=np.int32)
+    damage = np.zeros((len(records), 2, len(MOVE_KEYS)), dtype=np.int32)
+    encoded = []
+    for i, record in enumerate(records):
+        for j, character in enumerate(record.characters):
+            if character.hp is not None:
+                hp[i, j] = character.hp
+            damage[i, j] = [move.damage for move in character.moves]
+        encoded.extend(text.encode("utf-8") for text in _texts(record))
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in encoded], out=offsets[1:])
+    text = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    with open(path, "wb") as f:
+        np.savez_compressed(f, hp=hp, damage=damage, text=text, text_offsets=offsets)
+    return path
+
+
+class BattleArchive:
+    """
+    Records of a save_archive() file.
+
+    hp and damage are NumPy arrays over all records, for scans that don't
+    need text. Indexing or iterating builds full BattleRecords.
+    """
+
+    def __init__(self, path):
+        import numpy as np
+
+        with np.load(path) as data:
+            self.hp = data["hp"]
+            self.damage = data["damage"]
+            self._text = data["text"].tobytes()
+            self._offsets = data["text_offsets"]
+
+    def __len__(self):
+        return len(self.hp)
+
+    def text(self, i, field):
+        """The field-th text field of record i, see _texts() for the order."""
+        start, end = self._offsets[i * _TEXTS_PER_RECORD + field:i * _TEXTS_PER_RECORD + field + 2]
+        return self._text[start:end].decode("utf-8")
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        texts = [self.text(i, field) for field in range(_TEXTS_PER_RECORD)]
+        characters = []
+        for j in range(2):
+            base = j * _TEXTS_PER_CHARACTER
+            moves = tuple(Move(texts[base + 2 + 2 * k], texts[base + 3 + 2 * k], int(self.damage[i, j, k]))
+                          for k in range(len(MOVE_KEYS)))
+            hp = int(self.hp[i, j])
+            characters.append(Character(texts[base], texts[base + 1], moves, None if hp == NO_HP else hp))
+        return BattleRecord(characters[0], characters[1], texts[-1])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    pack = commands.add_parser("pack", help="Pack battle JSON files into an archive")
+    pack.add_argument("archive")
+    pack.add_argument("files", nargs="+")
+    info = commands.add_parser("info", help="Summarize an archive")
+    info.add_argument("archive")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        records = []
+        for path in args.files:
+            try:
+                records.append(load_battle_file(path))
+            except (OSError, ValueError) as e:
+                print(f"Skipping {path}: {e}")
+        save_archive(records, args.archive)
+        print(f"Packed {len(records)} battles into {args.archive}")
+    else:
+        archive = BattleArchive(args.archive)
+        print(f"{len(archive)} battles")
+        if len(archive):
+            print(f"Mean move damage: {archive.damage.mean():.1f}, max: {archive.damage.max()}")
+            print(f"Battles with HP: {int((archive.hp != NO_HP).all(axis=1).sum())}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""
+Battle sessions with a stable, cacheable prompt prefix.
+
+generate_battle_messages() rebuilds the whole prompt every round: the
+instructions, both personas, the chosen moves and the free-text state of
+the previous round. A BattleSession builds the instructions and everything
+static about the two characters (personas, all four moves of each, the
+answer format) once, as the system message, and follows it with the rounds
+played so far. A round then only appends a short user message with the HP
+and the two chosen moves. Providers cache a repeated prompt prefix, so after
+the first round the static part and the earlier rounds are served from the
+cache instead of being processed again.
+
+The history grows by one compact exchange per round, without the
+narratives. When its estimated size passes BATTLE_HISTORY_TOKENS, the oldest
+rounds are folded into a one-line-per-round recap, keeping the last
+BATTLE_KEEP_ROUNDS rounds verbatim.
+"""
+
+import copy
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from gen_chat_prompt import BATTLE_SYSTEM_PROMPT, request_messages
+import metrics
+
+# Load environment variables
+load_dotenv()
+
+# Estimated tokens of round history (recap included) kept before compacting
+BATTLE_HISTORY_TOKENS = int(os.getenv("BATTLE_HISTORY_TOKENS", "1500"))
+# Rounds always kept verbatim after the recap
+BATTLE_KEEP_ROUNDS = int(os.getenv("BATTLE_KEEP_ROUNDS", "2"))
+# Sessions kept by get_session(), least recently used ones are dropped
+BATTLE_SESSIONS_MAX = int(os.getenv("BATTLE_SESSIONS_MAX", "256"))
+
+# Rough size of a token for English prose, used when the provider doesn't
+# report usage
+CHARS_PER_TOKEN = 4
+
+ROUND_FORMAT = (
+    "Every round you are told both players' HP and chosen moves. Answer with only this JSON object:\n"
+    "{\n"
+    '   "effectiveness_1": effectiveness of move chosen by Player1,\n'
+    '   "damage_1": damage done by Player1\'s move to Player2,\n'
+    '   "narrative_1": your narration of Player1\'s move,\n'
+    '   "effectiveness_2": effectiveness of move chosen by Player2,\n'
+    '   "damage_2": damage done by Player2\'s move to Player1,\n'
+    '   "narrative_2": your narration of Player2\'s move,\n'
+    '   "summary": summary of the effects from this round that may affect effectiveness in the next round. '
+    "Do not include HP of players.\n"
+    "}\n"
+    "If either player's health falls below 0, declare the other player the victor and conclude with a "
+    "compelling and dramatic story about their triumph."
+)
+
+# Round fields kept in the history, the narratives are only shown to players
+_HISTORY_FIELDS = ("effectiveness_1", "damage_1", "effectiveness_2", "damage_2", "summary")
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _player_context(label, player):
+    lines = [f"{label}: {player['name']}", f"Persona: {player['persona']}", "Moves:"]
+    for key in ("move_1", "move_2", "move_3", "move_4"):
+        move = player[key]
+        lines.append(f"- {key}: {move['name']} (damage {move['dmg']}): {move['description']}")
+    return "\n".join(lines)
+
+
+def build_prefix(player1, player2):
+    """The system message of a session: instructions, both characters and the answer format."""
+    return "\n\n".join([BATTLE_SYSTEM_PROMPT, _player_context("Player1", player1),
+                        _player_context("Player2", player2), ROUND_FORMAT])
+
+
+class BattleSession:
+    """
+    One battle's prompt prefix, round history and token accounting.
+
+    The session keeps its own copy of the players and applies each round's
+    damage to it, so the HP sent to the model is always the session's.
+
+    Args:
+        player1 (dict): gen_chat_prompt player dict
+        player2 (dict): gen_chat_prompt player dict
+        history_tokens (int): History budget (default: BATTLE_HISTORY_TOKENS)
+        keep_rounds (int): Rounds kept verbatim (default: BATTLE_KEEP_ROUNDS)
+    """
+
+    def __init__(self, player1, player2, history_tokens=None, keep_rounds=None):
+        self.players = (copy.deepcopy(player1), copy.deepcopy(player2))
+        self.history_tokens = history_tokens or BATTLE_HISTORY_TOKENS
+        self.keep_rounds = BATTLE_KEEP_ROUNDS if keep_rounds is None else keep_rounds
+        self.prefix = build_prefix(*self.players)
+        self.prefix_tokens = estimate_tokens(self.prefix)
+        self.round_number = 0
+        # Exchanges of the rounds kept verbatim, oldest first
+        self.history = []
+        # One line per round folded out of the history
+        self.recap = []
+        self.compactions = 0
+        # Token accounting, one dict per round played
+        self.rounds = []
+        self._lock = threading.Lock()
+
+    def same_players(self, player1, player2):
+        """Whether the players are this session's, HP aside since the session tracks its own."""
+        return all({key: value for key, value in ours.items() if key != "hp"}
+                   == {key: value for key, value in theirs.items() if key != "hp"}
+                   for ours, theirs in zip(self.players, (player1, player2)))
+
+    @property
+    def hp(self):
+        return self.players[0]["hp"], self.players[1]["hp"]
+
+    @property
+    def both_alive(self):
+        return self.players[0]["hp"] > 0 and self.players[1]["hp"] > 0
+
+    def _recap_message(self):
+        return "Earlier rounds:\n" + "\n".join(self.recap)
+
+    def _history_messages(self):
+        messages = []
+        if self.recap:
+            # A user/assistant pair keeps the roles alternating
+            messages.append({"role": "user", "content": self._recap_message()})
+            messages.append({"role": "assistant", "content": "Understood."})
+        for entry in self.history:
+            messages.append({"role": "user", "content": entry["user"]})
+            messages.append({"role": "assistant", "content": entry["assistant"]})
+        return messages
+
+    def _history_size(self):
+        size = estimate_tokens(self._recap_message()) if self.recap else 0
+        return size + sum(entry["tokens"] for entry in self.history)
+
+    def delta(self, move_1, move_2):
+        """The user message of the next round."""
+        player1, player2 = self.players
+        return (f"Round {self.round_number + 1}\n"
+                f"Player1 HP: {player1['hp']}, uses {move_1}: {player1[move_1]['name']}\n"
+                f"Player2 HP: {player2['hp']}, uses {move_2}: {player2[move_2]['name']}")
+
+    def messages(self, move_1, move_2):
+        """Prefix, history and the next round's delta as chat messages."""
+        return ([{"role": "system", "content": self.prefix}] + self._history_messages()
+                + [{"role": "user", "content": self.delta(move_1, move_2)}])
+
+    def record(self, move_1, move_2, round_json, usage=None):
+        """
+        Adds a played round to the history and applies its damage
+
+        Args:
+            move_1 (str): Player1's move key
+            move_2 (str): Player2's move key
+            round_json (dict): The validated round
+            usage (dict): prompt_tokens and completion_tokens reported by the
+                provider, if any
+
+        Returns:
+            dict: Token accounting of the round
+        """
+        with self._lock:
+            delta = self.delta(move_1, move_2)
+            history_size = self._history_size()
+            player1, player2 = self.players
+            player1["hp"] -= round_json["damage_2"]
+            player2["hp"] -= round_json["damage_1"]
+            self.round_number += 1
+
+            assistant = json.dumps({key: round_json[key] for key in _HISTORY_FIELDS},
+                                   separators=(",", ":"), ensure_ascii=False)
+            self.history.append({
+                "user": delta,
+                "assistant": assistant,
+                "tokens": estimate_tokens(delta) + estimate_tokens(assistant),
+                "line": (f"Round {self.round_number}: {player1[move_1]['name']} "
+                         f"(effectiveness {round_json['effectiveness_1']}, {round_json['damage_1']} damage) vs "
+                         f"{player2[move_2]['name']} (effectiveness {round_json['effectiveness_2']}, "
+                         f"{round_json['damage_2']} damage). {round_json['summary']}"),
+            })
+
+            usage = usage or {}
+            estimated = self.prefix_tokens + history_size + estimate_tokens(delta)
+            tokens = {
+                "round": self.round_number,
+                "prefix_tokens": self.prefix_tokens,
+                "history_tokens": history_size,
+                "delta_tokens": estimate_tokens(delta),
+                "prompt_tokens": usage.get("prompt_tokens") or estimated,
+                "completion_tokens": usage.get("completion_tokens"),
+                "estimated": not usage.get("prompt_tokens"),
+            }
+            self.rounds.append(tokens)
+            metrics.BATTLE_PROMPT_TOKENS.observe(tokens["prompt_tokens"])
+            self._compact()
+        return tokens
+
+    def _compact(self):
+        folded = False
+        while self._history_size() > self.history_tokens and len(self.history) > self.keep_rounds:
+            self.recap.append(self.history.pop(0)["line"])
+            folded = True
+        # The recap itself gets at most half of the budget, oldest lines go first
+        while len(self.recap) > 1 and estimate_tokens(self._recap_message()) > self.history_tokens // 2:
+            self.recap.pop(0)
+            folded = True
+        if folded:
+            self.compactions += 1
+
+    def play_round(self, move_1, move_2):
+        """
+        Asks the LLM to resolve and narrate the next round
+
+        Returns:
+            tuple: (round_json, raw_response)
+        """
+        round_json, out, usage = request_messages(self.messages(move_1, move_2))
+        self.record(move_1, move_2, round_json, usage)
+        return round_json, out
+
+    def stats(self):
+        """Totals of the token accounting."""
+        prompt = [tokens["prompt_tokens"] for tokens in self.rounds]
+        return {
+            "rounds": self.round_number,
+            "prompt_tokens": sum(prompt),
+            "mean_prompt_tokens": round(sum(prompt) / len(prompt), 1) if prompt else 0,
+            "prefix_tokens": self.prefix_tokens,
+            "history_tokens": self._history_size(),
+            "compactions": self.compactions,
+        }
+
+
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+def get_session(battle_id, player1=None, player2=None):
+    """
+    Returns the session of a battle, creating it from the players if needed
+
+    Raises:
+        KeyError: If there is no such session and no players were given
+    """
+    with _sessions_lock:
+        session = _sessions.get(battle_id)
+        if session is None:
+            if player1 is None or player2 is None:
+                raise KeyError(battle_id)
+            session = _sessions[battle_id] = BattleSession(player1, player2)
+            while len(_sessions) > BATTLE_SESSIONS_MAX:
+                _sessions.popitem(last=False)
+        else:
+            _sessions.move_to_end(battle_id)
+        return session
+
+
+def end_session(battle_id):
+    with _sessions_lock:
+        return _sessions.pop(battle_id, None)
@@ -0,0 +1,418 @@
+"""
+Offline benchmark of the generation pipeline and the battle loop.
+
+Every provider call is answered from the recorded responses in
+fixtures/replay.json after a simulated latency drawn from that provider's
+log-normal distribution, so the benchmark needs no network or API keys and
+can run in CI. Scenarios:
+
+    generate   web_search_maestro.generate_battle: routing, balance check, save, images
+    images     image_gen.main on a fixture battle: generation, download, background removal
+    battle     gen_chat_prompt.run_battle on a fixture battle (--engine llm or local)
+
+Latencies are multiplied by --latency-scale (default 0.05), so a run takes
+seconds while the relative timings stay realistic. Each scenario reports
+throughput, p50/p95/p99 latency, peak RSS and the mean time per stage.
+
+    python benchmark.py --scenario all --iterations 20 --concurrency 4
+    python benchmark.py --json bench.json --baseline baseline.json --tolerance 0.25
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "replay.json")
+SCENARIOS = ("generate", "images", "battle")
+
+
+class Replay:
+    """
+    Recorded responses and latency distributions
+
+    Args:
+        path (str): Fixture file (default: fixtures/replay.json)
+        latency_scale (float): Multiplier for every simulated latency, 0 for none
+        seed (int): Seed for the latency and response choices
+    """
+
+    def __init__(self, path=FIXTURES, latency_scale=0.05, seed=None):
+        with open(path) as f:
+            self.data = json.load(f)
+        base = os.path.dirname(os.path.abspath(path))
+        self.battles = []
+        for battle_path in self.data["battles"]:
+            with open(os.path.join(base, battle_path)) as f:
+                self.battles.append(json.load(f))
+        self.latency_scale = latency_scale
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._image = None
+        self._count = 0
+
+    def latency(self, kind):
+        settings = self.data["latency"][kind]
+        with self._lock:
+            noise = self.rng.gauss(0, settings["sigma"])
+        return settings["median"] * math.exp(noise) * self.latency_scale
+
+    def sleep(self, kind):
+        time.sleep(self.latency(kind))
+
+    def _next(self, items):
+        with self._lock:
+            self._count += 1
+            return items[self._count % len(items)]
+
+    def battle(self):
+        return json.loads(json.dumps(self._next(self.battles)))
+
+    def battle_text(self, template):
+        return self.data[template].replace("{battle}", json.dumps(self.battle(), indent=4))
+
+    def round_text(self):
+        return self._next(self.data["rounds"])
+
+    def image_bytes(self):
+        """A generated-looking sprite on a white background, as JPEG bytes."""
+        if self._image is None:
+            from PIL import Image, ImageDraw
+
+            width, height = self.data["image_size"]
+            image = Image.new("RGB", (width, height), "white")
+            draw = ImageDraw.Draw(image)
+            draw.ellipse((width // 4, height // 6, width * 3 // 4, height * 5 // 6), fill=(220, 80, 40))
+            draw.rectangle((width * 2 // 5, height // 3, width * 3 // 5, height * 2 // 3), fill=(40, 60, 200))
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=90)
+            self._image = buffer.getvalue()
+        return self._image
+
+
+def _message(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class ReplayAI21:
+    """Answers Maestro runs and jamba chat completions, streamed or not."""
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.beta = SimpleNamespace(maestro=SimpleNamespace(runs=SimpleNamespace(create_and_poll=self._maestro)))
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+
+    def _maestro(self, input=None, requirements=None, **kwargs):
+        self.replay.sleep("maestro")
+        return SimpleNamespace(result=self.replay.battle_text("maestro_template"))
+
+    def _chat(self, model=None, messages=None, stream=False, **kwargs):
+        from router import JAMBA_SYSTEM_PROMPT
+
+        if messages and messages[0].content == JAMBA_SYSTEM_PROMPT:
+            text = json.dumps(self.replay.battle(), indent=4)
+        else:
+            text = self.replay.round_text()
+        if stream:
+            return self._stream(text)
+        self.replay.sleep("jamba")
+        return _message(text)
+
+    def _stream(self, text, chunk_size=16):
+        chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+        delay = self.replay.latency("jamba") / max(len(chunks), 1)
+        for chunk in chunks:
+            time.sleep(delay)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=chunk))])
+
+
+class ReplayImages:
+    """Answers grok-2-image generations with URLs that ReplaySession serves."""
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.images = SimpleNamespace(generate=self._generate)
+
+    def _generate(self, model=None, prompt=None, n=1, **kwargs):
+        self.replay.sleep("grok_image")
+        return SimpleNamespace(data=[SimpleNamespace(url=f"https://replay.invalid/{i}.jpg") for i in range(n)])
+
+
+class ReplayResponse:
+    def __init__(self, content=b"", payload=None):
+        self.status_code = 200
+        self.content = content
+        self.text = content.decode("latin-1") if content else json.dumps(payload)
+        self._payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._payload
+
+
+class ReplaySession:
+    """Stands in for the shared requests.Session: image downloads and the OpenAI REST call."""
+
+    def __init__(self, replay):
+        self.replay = replay
+
+    def get(self, url, **kwargs):
+        self.replay.sleep("download")
+        return ReplayResponse(content=self.replay.image_bytes())
+
+    def post(self, url, **kwargs):
+        self.replay.sleep("chatgpt")
+        content = self.replay.battle_text("chatgpt_template")
+        return ReplayResponse(payload={"choices": [{"message": {"role": "assistant", "content": content}}]})
+
+
+class ReplayRemover:
+    """Background removal with the recorded latency of the rembg model."""
+
+    def __init__(self, replay):
+        self.replay = replay
+
+    def remove(self, image):
+        self.replay.sleep("rembg")
+        return image.convert("RGBA")
+
+
+def player_from_character(character, default_hp=300):
+    """Builds a gen_chat_prompt player dict from a Character_N entry."""
+    from battle_engine import to_int
+
+    player = {
+        "name": character.get("Name", "Unknown Character"),
+        "persona": character.get("Character_Summary", ""),
+        "hp": to_int(character.get("HP"), default_hp) or default_hp,
+    }
+    for i in range(1, 5):
+        move = character["Moves"][f"Move_{i}"]
+        player[f"move_{i}"] = {"name": move.get("Move_name", f"Move {i}"), "description": move.get("Description", ""),
+                               "dmg": to_int(move.get("Damage"))}
+    return player
+
+
+def percentile(values, q):
+    """Nearest-rank percentile, q in 0-100."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class Benchmark:
+    def __init__(self, replay, workdir, engine="llm"):
+        self.replay = replay
+        self.workdir = workdir
+        self.engine = engine
+
+    def _output_dir(self, scenario, i):
+        path = os.path.join(self.workdir, scenario, str(i))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def generate(self, i):
+        from web_search_maestro import generate_battle
+
+        generate_battle(f"benchmark topic {i}", refresh=True, output_dir=self._output_dir("generate", i))
+
+    def images(self, i):
+        import image_gen
+
+        output_dir = self._output_dir("images", i)
+        battle_file = os.path.join(output_dir, "battle.json")
+        with open(battle_file, "w") as f:
+            json.dump(self.replay.battle(), f)
+        image_gen.main(battle_file, output_dir=output_dir)
+
+    def battle(self, i):
+        from gen_chat_prompt import run_battle
+
+        battle = self.replay.battle()
+        run_battle(player_from_character(battle["Character_1"]), player_from_character(battle["Character_2"]),
+                   engine=self.engine, seed=i)
+
+    def run(self, scenario, iterations, concurrency, warmup=1, verbose=False):
+        """
+        Runs a scenario and measures it
+
+        Returns:
+            dict: Throughput, latency percentiles, errors, peak RSS and mean stage times
+        """
+        import metrics
+
+        fn = getattr(self, scenario)
+        latencies = []
+        errors = []
+        stages = {}
+        lock = threading.Lock()
+
+        def one(i):
+            start = time.perf_counter()
+            with metrics.trace() as trace:
+                try:
+                    fn(i)
+                except Exception as e:
+                    with lock:
+                        errors.append(f"{type(e).__name__}: {e}")
+                    return
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                for stage, totals in trace.breakdown()["stages"].items():
+                    stages[stage] = stages.get(stage, 0.0) + totals["seconds"]
+
+        out = sys.stdout if verbose else io.StringIO()
+        with contextlib.redirect_stdout(out):
+            for i in range(warmup):
+                fn(-1 - i)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(one, range(iterations)))
+            wall = time.perf_counter() - start
+
+        completed = len(latencies)
+        return {
+            "scenario": scenario,
+            "iterations": iterations,
+            "concurrency": concurrency,
+            "completed": completed,
+            "errors": len(errors),
+            "first_error": errors[0] if errors else None,
+            "wall_seconds": round(wall, 3),
+            "throughput": round(completed / wall, 3) if wall else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "peak_rss_mb": peak_rss_mb(),
+            "stage_seconds": {stage: round(total / max(completed, 1), 4) for stage, total in sorted(stages.items())},
+        }
+
+
+@contextlib.contextmanager
+def replaying(replay):
+    """Routes every provider client, download and background removal through the replay."""
+    import bg_removal
+    import providers
+
+    ai21 = ReplayAI21(replay)
+    images = ReplayImages(replay)
+    previous_remover = bg_removal.set_remover(ReplayRemover(replay))
+    try:
+        with providers.replace({"ai21": ai21, "xai": images, "openai": images}, session=ReplaySession(replay)):
+            yield
+    finally:
+        bg_removal.set_remover(previous_remover)
+
+
+def _prepare_environment(use_cache):
+    # Read by the pipeline modules when they are first imported
+    for settings_env in ("AI21_API_KEY", "OPENAI_API_KEY", "XAI_API_KEY"):
+        os.environ.setdefault(settings_env, "replay")
+    if not use_cache:
+        os.environ["SPRITE_CACHE"] = "0"
+
+
+def compare(results, baseline, tolerance):
+    """Returns a message for every scenario that got worse than baseline by more than tolerance."""
+    regressions = []
+    previous = {result["scenario"]: result for result in baseline}
+    for result in results:
+        before = previous.get(result["scenario"])
+        if before is None:
+            continue
+        for key in ("p50", "p95"):
+            if before.get(key) and result.get(key) and result[key] > before[key] * (1 + tolerance):
+                regressions.append(f"{result['scenario']} {key}: {before[key]:.3f}s -> {result[key]:.3f}s")
+        if before.get("throughput") and result.get("throughput") \
+                and result["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{result['scenario']} throughput: {before['throughput']:.2f}/s -> "
+                               f"{result['throughput']:.2f}/s")
+        if result["errors"] > before.get("errors", 0):
+            regressions.append(f"{result['scenario']} errors: {before.get('errors', 0)} -> {result['errors']}")
+    return regressions
+
+
+def format_result(result):
+    def seconds(value):
+        return f"{value:.3f}s" if value is not None else "-"
+
+    lines = [f"{result['scenario']}: {result['completed']}/{result['iterations']} ok at concurrency "
+             f"{result['concurrency']}, {result['throughput']}/s, p50 {seconds(result['p50'])}, "
+             f"p95 {seconds(result['p95'])}, p99 {seconds(result['p99'])}, peak RSS {result['peak_rss_mb']} MB"]
+    if result["first_error"]:
+        lines.append(f"  first error: {result['first_error']}")
+    for stage, value in result["stage_seconds"].items():
+        lines.append(f"  {stage:<16} {value:.4f}s")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured runs per scenario")
+    parser.add_argument("--latency-scale", type=float, default=0.05)
+    parser.add_argument("--engine", choices=("llm", "local"), default="llm", help="Battle scenario engine")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fixtures", default=FIXTURES)
+    parser.add_argument("--cache", action="store_true", help="Keep the sprite cache enabled")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown against --baseline")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's own output")
+    args = parser.parse_args(argv)
+
+    _prepare_environment(args.cache)
+    replay = Replay(args.fixtures, latency_scale=args.latency_scale, seed=args.seed)
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as workdir, replaying(replay):
+        bench = Benchmark(replay, workdir, engine=args.engine)
+        for scenario in scenarios:
+            result = bench.run(scenario, args.iterations, args.concurrency, args.warmup, args.verbose)
+            results.append(result)
+            print(format_result(result))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions:\n  " + "\n  ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+"""
+Process-wide background removal service.
+
+rembg.remove() builds a fresh ONNX session on every call unless one is passed
+in. This module keeps a single session per process, created on first use or
+by an explicit warm_up(), and shares it between all requests.
+
+Character sprites are generated on a plain white background, so most of them
+don't need the model at all: remove_white_background() flood-fills the
+near-white pixels connected to the image border and cleans up the alpha
+edge with NumPy in a few milliseconds. remove_background() only falls back
+to rembg when the resulting mask doesn't look like a sprite on white.
+"""
+
+import os
+import threading
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+
+import metrics
+
+# Load environment variables
+load_dotenv()
+
+REMBG_MODEL = os.getenv("REMBG_MODEL", "u2net")
+# 0 lets onnxruntime pick the thread counts itself
+REMBG_INTRA_OP_THREADS = int(os.getenv("REMBG_INTRA_OP_THREADS", "0"))
+REMBG_INTER_OP_THREADS = int(os.getenv("REMBG_INTER_OP_THREADS", "0"))
+# Comma separated onnxruntime providers, e.g. "CUDAExecutionProvider,CPUExecutionProvider"
+REMBG_PROVIDERS = [p for p in os.getenv("REMBG_PROVIDERS", "").split(",") if p]
+# "auto" tries the white background fast path first, "fast" never uses the
+# model, "rembg" always does
+BG_REMOVAL_MODE = os.getenv("BG_REMOVAL_MODE", "auto")
+# How far from pure white (and from gray) a background pixel may be
+BG_WHITE_TOLERANCE = int(os.getenv("BG_WHITE_TOLERANCE", "24"))
+
+# Fast path confidence checks: share of border pixels that must be white,
+# share of border pixels the sprite may cover and the allowed range of the
+# foreground's share of the image
+FAST_MIN_BORDER_WHITE = 0.85
+FAST_MAX_BORDER_FOREGROUND = 0.15
+FAST_FOREGROUND_RANGE = (0.02, 0.9)
+
+
+class BackgroundRemover:
+    """
+    Wraps one rembg session for reuse across threads.
+
+    onnxruntime's InferenceSession.run is thread safe, so the only locking
+    needed is around creating the session.
+
+    Args:
+        model_name (str): rembg model name (default: REMBG_MODEL)
+        intra_op_threads (int): onnxruntime intra-op thread count, 0 for default
+        inter_op_threads (int): onnxruntime inter-op thread count, 0 for default
+        providers (list): onnxruntime execution providers, None for rembg's choice
+    """
+
+    def __init__(self, model_name=None, intra_op_threads=None, inter_op_threads=None, providers=None):
+        self.model_name = model_name or REMBG_MODEL
+        self.intra_op_threads = REMBG_INTRA_OP_THREADS if intra_op_threads is None else intra_op_threads
+        self.inter_op_threads = REMBG_INTER_OP_THREADS if inter_op_threads is None else inter_op_threads
+        self.providers = providers or REMBG_PROVIDERS or None
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def _create_session(self):
+        import onnxruntime as ort
+        from rembg import new_session
+
+        sess_opts = ort.SessionOptions()
+        sess_opts.intra_op_num_threads = self.intra_op_threads
+        sess_opts.inter_op_num_threads = self.inter_op_threads
+
+        kwargs = {"sess_opts": sess_opts}
+        if self.providers:
+            kwargs["providers"] = self.providers
+
+        print(f"Loading background removal model '{self.model_name}'...")
+        return new_session(self.model_name, **kwargs)
+
+    def remove(self, image):
+        """Removes the background from a PIL image and returns an RGBA image."""
+        from rembg import remove
+
+        return remove(image, session=self.session)
+
+    def warm_up(self):
+        """Loads the model and runs one tiny inference so later calls start hot."""
+        self.remove(Image.new("RGB", (64, 64), "white"))
+        print(f"Background removal model '{self.model_name}' is warm")
+
+
+def _spread_runs(reached, passable):
+    """Extends reached to every horizontal run of passable pixels it touches."""
+    previous = np.zeros_like(passable)
+    previous[:, 1:] = passable[:, :-1]
+    run_ids = np.cumsum(passable & ~previous).reshape(passable.shape)
+    run_ids[~passable] = 0
+    reached_runs = np.zeros(int(run_ids.max()) + 1, dtype=bool)
+    reached_runs[run_ids[reached & passable]] = True
+    reached_runs[0] = False
+    return reached_runs[run_ids]
+
+
+def flood_fill_from_edges(passable, max_passes=64):
+    """
+    Flood fills the passable pixels connected (4-way) to the image border
+
+    Instead of visiting pixels one by one, each pass spreads the filled area
+    along whole rows and then whole columns of passable pixels with NumPy, so
+    a convex background is done in one or two passes.
+
+    Args:
+        passable (np.ndarray): 2D bool mask of pixels the fill may enter
+
+    Returns:
+        np.ndarray: 2D bool mask of the filled pixels
+    """
+    reached = np.zeros_like(passable)
+    reached[[0, -1], :] = passable[[0, -1], :]
+    reached[:, [0, -1]] = passable[:, [0, -1]]
+    passable_t = np.ascontiguousarray(passable.T)
+    for _ in range(max_passes):
+        spread = _spread_runs(reached, passable)
+        spread = _spread_runs(np.ascontiguousarray(spread.T), passable_t).T
+        if np.array_equal(spread, reached):
+            break
+        reached = spread
+    return reached
+
+
+def _dilate(mask):
+    grown = mask.copy()
+    grown[1:, :] |= mask[:-1, :]
+    grown[:-1, :] |= mask[1:, :]
+    grown[:, 1:] |= mask[:, :-1]
+    grown[:, :-1] |= mask[:, 1:]
+    return grown
+
+
+def _border(array):
+    return np.concatenate([array[0, :], array[-1, :], array[1:-1, 0], array[1:-1, -1]])
+
+
+def check_mask(stats):
+    """Returns why a fast path mask looks wrong, or None if it looks like a sprite on white."""
+    if stats["border_white"] < FAST_MIN_BORDER_WHITE:
+        return f"only {stats['border_white']:.0%} of the border is white"
+    if stats["border_foreground"] > FAST_MAX_BORDER_FOREGROUND:
+        return f"the sprite covers {stats['border_foreground']:.0%} of the border"
+    low, high = FAST_FOREGROUND_RANGE
+    if not low <= stats["foreground"] <= high:
+        return f"the sprite covers {stats['foreground']:.0%} of the image"
+    return None
+
+
+def remove_white_background(image, tolerance=None):
+    """
+    Makes the near-white background connected to the border transparent
+
+    White areas enclosed by the sprite's outline (eyes, highlights) stay
+    opaque. The one pixel ring around the background gets partial alpha by
+    how white it is, which keeps anti-aliased outlines smooth.
+
+    Returns:
+        tuple: (rgba_image, stats) where stats has the foreground, border_white
+        and border_foreground fractions and "reason", the check_mask() result
+    """
+    tolerance = tolerance or BG_WHITE_TOLERANCE
+    rgb = np.asarray(image.convert("RGB"))
+    low = rgb.min(axis=2).astype(np.int16)
+    high = rgb.max(axis=2).astype(np.int16)
+    white = (low >= 255 - tolerance) & (high - low <= tolerance)
+
+    background = flood_fill_from_edges(white)
+    alpha = np.where(background, 0, 255).astype(np.uint8)
+    ring = _dilate(background) & ~background
+    # int32, (255 - low) * 255 doesn't fit in int16 for dark pixels. Only
+    # pixels within 2 * tolerance of white get partial alpha, darker ones
+    # (outlines) stay fully opaque
+    fringe = np.clip((255 - low.astype(np.int32)) * 255 // (2 * tolerance), 0, 255).astype(np.uint8)
+    alpha[ring] = fringe[ring]
+
+    stats = {
+        "foreground": float(1 - background.mean()),
+        "border_white": float(_border(white).mean()),
+        "border_foreground": float(1 - _border(background).mean()),
+    }
+    stats["reason"] = check_mask(stats)
+    return Image.fromarray(np.dstack([rgb, alpha]), "RGBA"), stats
+
+
+_remover = None
+_remover_lock = threading.Lock()
+
+
+def get_remover():
+    """Returns the process-wide BackgroundRemover."""
+    global _remover
+    if _remover is None:
+        with _remover_lock:
+            if _remover is None:
+                _remover = BackgroundRemover()
+    return _remover
+
+
+def set_remover(remover):
+    """Replaces the process-wide remover, returns the previous one (may be None)."""
+    global _remover
+    with _remover_lock:
+        previous, _remover = _remover, remover
+    return previous
+
+
+def remove_with_method(image, mode=None):
+    """
+    Removes the background of a character sprite
+
+    Args:
+        image (PIL.Image.Image): The generated sprite
+        mode (str): "auto", "fast" or "rembg" (default: BG_REMOVAL_MODE)
+
+    Returns:
+        tuple: (rgba_image, method) where method is "fast" or "rembg"
+    """
+    mode = mode or BG_REMOVAL_MODE
+    if mode != "rembg":
+        result, stats = remove_white_background(image)
+        if stats["reason"] is None or mode == "fast":
+            return result, "fast"
+        print(f"White background fast path rejected ({stats['reason']}), using rembg")
+    return get_remover().remove(image), "rembg"
+
+
+def remove_background(image, mode=None):
+    """remove_with_method() that counts the method used and returns only the image."""
+    result, method = remove_with_method(image, mode)
+    metrics.BG_REMOVALS.inc(method=method)
+    return result
+
+
+def warm_up():
+    get_remover().warm_up()
@@ -0,0 +1,199 @@
+"""
+Process pool for the CPU-bound stages.
+
+Background removal and sprite post-processing are NumPy/onnxruntime work
+that holds the GIL for long stretches, so running them on the request
+threads slows down every other request of the worker. With CPU_WORKERS > 0
+they run in a pool of separate processes instead, spread over all cores.
+
+Each pool process loads the background removal model once, in its
+initializer, and keeps it for its lifetime. Images are not pickled: the
+caller copies the pixels into a multiprocessing.shared_memory block and
+sends only its name, shape and mode; the result comes back the same way.
+
+With CPU_WORKERS=0 (the default, e.g. for `python flask_app.py`) everything
+runs inline in the calling thread.
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from dotenv import load_dotenv
+
+import metrics
+
+# Load environment variables
+load_dotenv()
+
+# Number of CPU worker processes, 0 runs the CPU stages inline
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", "0"))
+# Load the background removal model in every CPU worker when it starts
+CPU_WORKER_WARMUP = os.getenv("CPU_WORKER_WARMUP", "1") == "1"
+
+
+class SharedImage:
+    """
+    A PIL image's pixels in a named shared memory block.
+
+    Only the small descriptor returned by ref() crosses the process boundary.
+    Whoever creates the block unlinks it with release() once the other side
+    is done with it.
+    """
+
+    def __init__(self, shm, shape, mode):
+        self.shm = shm
+        self.shape = shape
+        self.mode = mode
+
+    @classmethod
+    def from_image(cls, image):
+        import numpy as np
+
+        if image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGBA")
+        pixels = np.asarray(image)
+        shm = shared_memory.SharedMemory(create=True, size=max(pixels.nbytes, 1))
+        np.ndarray(pixels.shape, dtype=np.uint8, buffer=shm.buf)[...] = pixels
+        return cls(shm, pixels.shape, image.mode)
+
+    @classmethod
+    def attach(cls, ref):
+        name, shape, mode = ref
+        return cls(shared_memory.SharedMemory(name=name), tuple(shape), mode)
+
+    def ref(self):
+        return (self.shm.name, self.shape, self.mode)
+
+    def to_image(self):
+        """Copies the pixels out of the block into a new PIL image."""
+        import numpy as np
+        from PIL import Image
+
+        pixels = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        return Image.fromarray(pixels.copy(), self.mode)
+
+    def close(self):
+        self.shm.close()
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _init_worker():
+    if not CPU_WORKER_WARMUP:
+        return
+    import bg_removal
+
+    if bg_removal.BG_REMOVAL_MODE != "fast":
+        try:
+            bg_removal.warm_up()
+        except Exception as e:
+            print(f"CPU worker {os.getpid()} could not load the background removal model: {e}")
+
+
+def _remove_background_task(ref):
+    from bg_removal import remove_with_method
+
+    source = SharedImage.attach(ref)
+    try:
+        image = source.to_image()
+    finally:
+        source.close()
+    result, method = remove_with_method(image)
+    output = SharedImage.from_image(result)
+    # The caller unlinks the result block after copying it out
+    output.close()
+    return output.ref(), method
+
+
+def _worker_pid(_):
+    return os.getpid()
+
+
+def _post_process_task(images, output_dir):
+    import sprite_post
+
+    return sprite_post.post_process(images, output_dir)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process-wide pool, None when CPU_WORKERS is 0
+
+    The pool is created on first use in the process that uses it, so a
+    pre-forking server gets one pool per worker process rather than one
+    inherited from its master.
+    """
+    global _pool, _pool_pid
+    if CPU_WORKERS <= 0:
+        return None
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                # spawn, because forking a process with running threads can
+                # copy locks held by those threads into the child
+                _pool = ProcessPoolExecutor(max_workers=CPU_WORKERS, initializer=_init_worker,
+                                            mp_context=multiprocessing.get_context("spawn"))
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def remove_background(image):
+    """
+    bg_removal.remove_background(), run in the CPU pool when there is one
+
+    Returns:
+        PIL.Image.Image: RGBA image
+    """
+    pool = get_pool()
+    if pool is None:
+        from bg_removal import remove_background as remove_inline
+
+        return remove_inline(image)
+
+    source = SharedImage.from_image(image)
+    try:
+        ref, method = pool.submit(_remove_background_task, source.ref()).result()
+    finally:
+        source.release()
+    output = SharedImage.attach(ref)
+    try:
+        result = output.to_image()
+    finally:
+        output.release()
+    metrics.BG_REMOVALS.inc(method=method)
+    return result
+
+
+def post_process(images, output_dir):
+    """sprite_post.post_process(), run in the CPU pool when there is one."""
+    pool = get_pool()
+    if pool is None:
+        import sprite_post
+
+        return sprite_post.post_process(images, output_dir)
+    return pool.submit(_post_process_task, images, output_dir).result()
+
+
+def warm_up():
+    """Starts every pool process, so their initializers load the model now."""
+    pool = get_pool()
+    if pool is not None:
+        list(pool.map(_worker_pid, range(CPU_WORKERS)))
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
@@ -1,18 +1,213 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
+import json
+import os
+import threading
 import time
-from web_search_maestro import main
+import artifacts
+import battle_cache
+import battle_session
+import metrics
+import resilience
+import router
+import sprite_cache
+import stream_battle
+import warmup
+from jobs import JobQueue, QueueFull
+from web_search_maestro import generate_battle
 
 app = Flask(__name__)
 CORS(app)  # Enables Cross-Origin requests (important for React frontend)
 
-@app.route('/api/generate_image')
+# Generation jobs run on a small pool of worker threads; anything beyond
+# JOB_QUEUE_SIZE waiting jobs is rejected with 429
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "8"))
+
+jobs = JobQueue(workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE)
+
+# Heavy modules, clients and the background removal model load lazily; warm
+# them up at startup instead of on the first request (REMBG_WARMUP is the
+# old name of the setting)
+WARMUP = os.getenv("WARMUP", os.getenv("REMBG_WARMUP", "1")) == "1"
+
+
+def warm_up():
+    """Loads heavy modules and models so the first user request doesn't pay for it."""
+    print(f"Warm-up: {warmup.warm_up()}")
+
+
+def run_generation(job, topic, refresh=False):
+    store = artifacts.get_store()
+    store.gc()
+
+    with metrics.trace() as trace:
+        result = generate_battle(topic, on_stage=job.set_stage, refresh=refresh,
+                                 output_dir=store.job_dir(job.id))
+        result['manifest'] = store.write_manifest(
+            job.id, {'battle': result['battle_file'], **result['images'], **result['sprites']}, topic=topic)
+    result['timings'] = trace.breakdown()
+    return result
+
+
+def _flag(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+@app.route('/api/generate_image', methods=['GET', 'POST'])
 def get_data():
-    topic = request.args.get('topic', '')
+    body = request.get_json(silent=True) or {}
+    topic = request.args.get('topic') or body.get('topic', '')
+    refresh = _flag(request.args.get('refresh', body.get('refresh', False)))
+
+    # A recently generated battle is returned right away; the job then only
+    # has to restore its images
+    battle = None if refresh else battle_cache.get_cache().get(topic)
+
+    try:
+        job = jobs.submit('generate_image', run_generation, topic, refresh=refresh)
+    except QueueFull:
+        response = jsonify({'error': 'Too many generation requests, try again later'})
+        response.headers['Retry-After'] = '30'
+        return response, 429
+
+    return jsonify({
+        'message': 'Image generation started',
+        'job_id': job.id,
+        'status_url': f'/api/jobs/{job.id}',
+        'result_url': f'/api/jobs/{job.id}/result',
+        'events_url': f'/api/jobs/{job.id}/events',
+        'manifest_url': f'/api/jobs/{job.id}/manifest',
+        'cached': battle is not None,
+        'battle': battle,
+    }), 202
+
+
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/api/jobs/<job_id>/result')
+def job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if not job.finished:
+        return jsonify(job.to_dict()), 202
+    if job.error is not None:
+        return jsonify(job.to_dict()), 500
+    return jsonify({**job.to_dict(), 'result': job.result})
+
+
+@app.route('/api/jobs/<job_id>/manifest')
+def job_manifest(job_id):
+    # Read from disk so any worker process can answer for any job
+    try:
+        manifest = artifacts.get_store().read_manifest(job_id)
+    except ValueError:
+        manifest = None
+    if manifest is None:
+        return jsonify({'error': 'No manifest for this job'}), 404
+    return jsonify(manifest)
+
+
+@app.route('/api/jobs/<job_id>/events')
+def job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    def stream():
+        for event, data in job.iter_events():
+            if event == 'ping':
+                # SSE comment line, keeps proxies from closing the connection
+                yield f': ping {time.time():.0f}\n\n'
+            else:
+                yield _sse(event, data)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+@app.route('/api/battle/stream', methods=['POST'])
+def battle_stream():
+    """
+    Streams one battle round as server-sent events
+
+    Expects a JSON body with player_1, player_2 (gen_chat_prompt player
+    dicts), move_1, move_2 and optionally the previous round's state. With a
+    battle_id the rounds of that battle share a battle_session.BattleSession,
+    which keeps the HP and history server-side and only sends the new round
+    to the model. Reusing a battle_id with different players is a 409.
+    """
+    body = request.get_json(silent=True) or {}
+    missing = [key for key in ('player_1', 'player_2', 'move_1', 'move_2') if key not in body]
+    if missing:
+        return jsonify({'error': f"Missing fields: {', '.join(missing)}"}), 400
+    session = None
+    if body.get('battle_id'):
+        session = battle_session.get_session(body['battle_id'], body['player_1'], body['player_2'])
+        if not session.same_players(body['player_1'], body['player_2']):
+            return jsonify({'error': f"Battle {body['battle_id']} is between other players"}), 409
+
+    def stream():
+        try:
+            for event in stream_battle.stream_round(body['player_1'], body['player_2'],
+                                                    body.get('state', 'None'),
+                                                    body['move_1'], body['move_2'], session=session):
+                if event[0] == 'delta':
+                    yield _sse('delta', {'field': event[1], 'text': event[2]})
+                elif event[0] == 'field_start':
+                    yield _sse('field_start', {'field': event[1]})
+                elif event[0] == 'field':
+                    yield _sse('field', {'field': event[1], 'value': event[2]})
+                else:
+                    yield _sse(event[0], event[1])
+        except Exception as e:
+            yield _sse('error', {'error': str(e)})
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/jobs')
+def job_stats():
+    return jsonify(jobs.stats())
+
+
+@app.route('/api/cache')
+def cache_stats():
+    sprites = sprite_cache.get_cache()
+    return jsonify({
+        'battles': battle_cache.get_cache().stats(),
+        'sprites': sprites.stats() if sprites is not None else None,
+    })
+
+
+@app.route('/api/providers')
+def provider_stats():
+    return jsonify({**resilience.stats(), 'router': router.get_router().stats()})
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/warmup')
+def warmup_status():
+    return jsonify(warmup.status())
 
-    main(topic)
-    
-    return jsonify({'message': 'Image have been generated'})
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    if WARMUP:
+        threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+    app.run(debug=True, threaded=True)
@@ -1,36 +1,27 @@
-from ai21 import AI21Client
-from ai21.models.chat import ChatMessage
+import argparse
+import copy
 import json
 import random
-import sys
+import uuid
+from battle_engine import BattleEngine, fighter_from_player
+from json_extract import extract_json, extract_round
+import metrics
+import providers
+import resilience
+
+# Overall instructions of the per-round battle prompt
+BATTLE_SYSTEM_PROMPT = (
+    "You are an immersive battle simulator, similar to Pokémon battles but adapted for a variety "
+    "of imaginative scenarios and characters.\n\n"
+    "There are two combatants: Player1 and Player2. Each has chosen one unique move for this round. "
+    "Your task is to vividly narrate the battle, clearly explaining how each player's chosen move impacts their opponent.\n\n"
+    "Each move has an effectiveness score ranging from 0 to 200 (inclusive):\n\n"
+    "An effectiveness of 0 indicates a complete miss or failure, causing no damage.\n\n"
+    "An effectiveness of 200 represents maximum damage and optimal impact.\n\n"
+    "Provide detailed context and storytelling that incorporates each player's background, chosen moves, "
+    "and the resulting effectiveness. Consider effects from the previous round when determining effectiveness. Clearly illustrate the dynamics and drama of the exchange."
+)
 
-def parse_json(json_str):
-    # Remove the Markdown code block markers
-    lines = json_str.splitlines()
-    
-    # Remove the first line if it starts with ```
-    if lines and lines[0].startswith("```"):
-        lines = lines[1:]
-    
-    # Remove the last line if it starts with ```
-    if lines and lines[-1].startswith("```"):
-        lines = lines[:-1]
-    
-    # Join the remaining lines into a clean JSON string
-    clean_json_str = "\n".join(lines)
-    
-    # Parse the clean JSON string
-    try:
-        data = json.loads(clean_json_str)
-        return data
-        # print("Parsed JSON successfully!")
-        # print("Effectiveness of move 1:", data["effectiveness_1"])
-        # print("Damage of move 1:", data["damage_1"])
-        # print("Narrative for move 1:", data["narrative_1"])
-        # print("Summary:", data["summary"])
-    except:
-        return None
-    
 def generate_battle_messages(player1, player2, state, move_key1, move_key2):
     # Build Player1's context and move details
     p1_context = f"Name: {player1['name']}\nPersona: {player1['persona']}\nHP: {player1['hp']}"
@@ -42,19 +33,6 @@ def generate_battle_messages(player1, player2, state, move_key1, move_key2):
     move2 = player2[move_key2]
     move2_info = f"Name: {move2['name']}\nDescription: {move2['description']}\nDamage: {move2['dmg']}"
     
-    # Define the system prompt (overall instructions)
-    system_prompt = (
-        "You are an immersive battle simulator, similar to Pokémon battles but adapted for a variety "
-        "of imaginative scenarios and characters.\n\n"
-        "There are two combatants: Player1 and Player2. Each has chosen one unique move for this round. "
-        "Your task is to vividly narrate the battle, clearly explaining how each player's chosen move impacts their opponent.\n\n"
-        "Each move has an effectiveness score ranging from 0 to 200 (inclusive):\n\n"
-        "An effectiveness of 0 indicates a complete miss or failure, causing no damage.\n\n"
-        "An effectiveness of 200 represents maximum damage and optimal impact.\n\n"
-        "Provide detailed context and storytelling that incorporates each player's background, chosen moves, "
-        "and the resulting effectiveness. Consider effects from the previous round when determining effectiveness. Clearly illustrate the dynamics and drama of the exchange."
-    )
-    
     # Define the user prompt (combatants' details and move choices)
     user_prompt = (
         f"Context for Player1:\n{p1_context}\n"
@@ -78,6 +56,43 @@ def generate_battle_messages(player1, player2, state, move_key1, move_key2):
     )
     
     # Return the messages as a list of dictionaries
+    return [
+        {"role": "system", "content": BATTLE_SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def generate_narration_messages(player1, player2, state, move_key1, move_key2, resolved):
+    """
+    Builds messages asking the LLM only to narrate a round the local battle
+    engine already resolved, so the numbers stay fixed
+    """
+    move1 = player1[move_key1]
+    move2 = player2[move_key2]
+
+    system_prompt = (
+        "You are an immersive battle narrator, similar to Pokémon battles but adapted for a variety "
+        "of imaginative scenarios and characters.\n\n"
+        "The outcome of this round has already been decided. Vividly narrate it without changing "
+        "any of the numbers you are given."
+    )
+
+    user_prompt = (
+        f"Player1: {player1['name']}\nPersona: {player1['persona']}\n"
+        f"Move: {move1['name']} - {move1['description']}\n"
+        f"Effectiveness: {resolved['effectiveness_1']} / 200, damage dealt: {resolved['damage_1']}\n\n"
+        f"Player2: {player2['name']}\nPersona: {player2['persona']}\n"
+        f"Move: {move2['name']} - {move2['description']}\n"
+        f"Effectiveness: {resolved['effectiveness_2']} / 200, damage dealt: {resolved['damage_2']}\n\n"
+        f"Effects from the previous round:\n{state}\n\n"
+        f"Effects carried into the next round:\n{resolved['summary']}\n\n"
+        '''Your response must follow the format
+        {{
+           "narrative_1": your narration of Player1's move,
+           "narrative_2": your narration of Player2's move
+        }}
+        '''
+    )
+
     return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt}
@@ -91,10 +106,6 @@ def upd_players_and_state(p1, p2, out_json):
         alive = False
     return p1, p2, out_json['summary'], alive
 
-KEY = 'v7uBaXL8sXKB4SmHsrxIOa14sYsWPcT9'
-
-client = AI21Client(api_key=KEY)  # or pass it in directly
-
 # Example usage:
 p1 = {'name': 'Elon Musk',
       'persona': 'Elon Musk is an innovative and unpredictable entrepreneur whose ideas spark both inspiration and controversy. '
@@ -117,47 +128,223 @@ p2 = {'name': 'Harry Potter',
       'move_4': {'name': 'Sectumsempra', 'description': 'Inflicts deep wounds, causing heavy magical damage.', 'dmg': 45},
       }
 
-state = 'None'
 moves = ['move_1', 'move_2', 'move_3', 'move_4']
-round_number = 1
-both_alive = True
 
-while both_alive:
-    
-    move_1 = random.choice(moves)
-    move_2 = random.choice(moves)
-    
-    got_json = False
-    
-    try_count = 0
-    while not got_json:
-        messages = generate_battle_messages(p1, p2, state, move_1, move_2)
+
+def complete(messages):
+    """
+    Sends a jamba-large chat completion
+
+    Args:
+        messages (list): {"role", "content"} dicts
+
+    Returns:
+        tuple: (content, usage) where usage has prompt_tokens and
+        completion_tokens, or is None if the response didn't report them
+    """
+    from ai21.models.chat import ChatMessage
+
+    client = providers.get_client('ai21')
+    with providers.slot('ai21'):
         response = client.chat.completions.create(
             model='jamba-large',
-            messages=[ChatMessage(role='system', content=messages[0]['content']),
-                      ChatMessage(role='user', content=messages[1]['content'])],
+            messages=[ChatMessage(role=message['role'], content=message['content']) for message in messages],
             temperature=0.7
             )
-        out = response.choices[0].message.content
-        narrative_json = parse_json(out.strip())
-        if narrative_json is not None:
-            got_json = True
-        else:
-            try_count += 1
-            if try_count >= 50:
-                sys.exit('GOT SUTCK :(')
-    
-    print(f'\n\n============= Round {round_number} =============\n\n')
-    
-    p1, p2, state, both_alive = upd_players_and_state(p1, p2, narrative_json)
-    
-    print(out)
-    round_number += 1
-
-print('\n\n============= RESULT =============\n\n')
-if p1['hp'] > 0 and p1['hp'] <= 0:
-    print(f"{p1['name']} won!")
-elif p1['hp'] <= 0 and p1['hp'] > 0:
-    print(f"{p2['name']} won!")
-else:
-    print('It is a TIE')
\ No newline at end of file
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        usage = {'prompt_tokens': getattr(usage, 'prompt_tokens', None),
+                 'completion_tokens': getattr(usage, 'completion_tokens', None)}
+    return response.choices[0].message.content, usage
+
+
+def chat(messages):
+    return complete(messages)[0]
+
+
+@resilience.resilient('ai21', name='ai21.round')
+def request_messages(messages):
+    """Sends a round prompt, returns (round_json, raw_response, usage)."""
+    out, usage = complete(messages)
+    return extract_round(out.strip()), out, usage
+
+
+def local_round(engine, p1, p2, state, move_1, move_2, narrate=False):
+    """
+    Resolves a round with the local battle engine, optionally asking the LLM
+    to narrate the result
+    """
+    resolved = engine.resolve_round(move_1, move_2)
+    if narrate:
+        out = chat(generate_narration_messages(p1, p2, state, move_1, move_2, resolved))
+        try:
+            narration = extract_json(out)
+        except ValueError:
+            narration = None
+        if narration is not None:
+            resolved['narrative_1'] = narration.get('narrative_1', resolved['narrative_1'])
+            resolved['narrative_2'] = narration.get('narrative_2', resolved['narrative_2'])
+    return resolved, json.dumps(resolved, indent=4)
+
+
+class Battle:
+    """
+    One battle between two players, played a round at a time
+
+    With the llm engine a round is split in two: resolve() makes the
+    blocking provider request without changing the battle, and apply()
+    takes the result in. Schedulers run resolve() wherever they want, and
+    speculative rounds are resolved that were never applied. The local
+    engine's state moves on as it resolves, so its rounds only go through
+    play_round().
+
+    Args:
+        p1 (dict): Player1, copied
+        p2 (dict): Player2, copied
+        engine (str): 'local' resolves rounds with battle_engine, 'llm' asks jamba-large
+        narrate (bool): With the local engine, have the LLM narrate each round
+        seed (int): Seed for move choices and the local engine
+        session (bool): With the llm engine, send rounds through a
+            battle_session.BattleSession instead of rebuilding the whole
+            prompt every round
+        battle_id (str): Identifier, a random one by default
+        max_rounds (int): Rounds after which the battle is called a tie
+    """
+
+    def __init__(self, p1, p2, engine='local', narrate=False, seed=None, session=True, battle_id=None,
+                 max_rounds=100):
+        self.id = battle_id or uuid.uuid4().hex
+        self.p1 = copy.deepcopy(p1)
+        self.p2 = copy.deepcopy(p2)
+        self.engine = engine
+        self.narrate = narrate
+        self.rng = random.Random(seed)
+        self.battle_engine = BattleEngine(fighter_from_player(self.p1), fighter_from_player(self.p2), seed=seed)
+        self.session = None
+        if engine == 'llm' and session:
+            from battle_session import BattleSession
+
+            self.session = BattleSession(self.p1, self.p2)
+        self.state = 'None'
+        self.round_number = 0
+        self.max_rounds = max_rounds
+        self.both_alive = True
+
+    @property
+    def uses_provider(self):
+        """Whether rounds make a provider request (and should be rate limited)."""
+        return self.engine == 'llm' or self.narrate
+
+    @property
+    def winner(self):
+        """Name of the winner, None while both are alive or for a tie."""
+        if self.p1['hp'] > 0 and self.p2['hp'] <= 0:
+            return self.p1['name']
+        if self.p1['hp'] <= 0 and self.p2['hp'] > 0:
+            return self.p2['name']
+        return None
+
+    def choose_moves(self):
+        return self.rng.choice(moves), self.rng.choice(moves)
+
+    def messages(self, move_1, move_2):
+        """The llm round prompt for the moves in the battle's current state."""
+        if self.session is not None:
+            return self.session.messages(move_1, move_2)
+        return generate_battle_messages(self.p1, self.p2, self.state, move_1, move_2)
+
+    def resolve(self, move_1, move_2, messages=None):
+        """
+        Requests an llm round for the moves without changing the battle
+
+        Args:
+            messages (list): The prompt, if already built with messages()
+
+        Returns:
+            tuple: (round_json, raw_response, usage)
+        """
+        return request_messages(messages or self.messages(move_1, move_2))
+
+    def apply(self, move_1, move_2, round_json, usage=None):
+        """Takes a resolved round in: HP, state and the session history."""
+        if self.session is not None:
+            self.session.record(move_1, move_2, round_json, usage)
+        self.p1, self.p2, self.state, self.both_alive = upd_players_and_state(self.p1, self.p2, round_json)
+        if self.engine != 'llm':
+            # The engine also tracks healing and damage over time
+            self.p1['hp'], self.p2['hp'] = round_json['hp_1'], round_json['hp_2']
+            self.both_alive = self.battle_engine.both_alive
+        self.round_number += 1
+        if self.round_number >= self.max_rounds:
+            # Moves that never do damage would go on forever, stop as a tie
+            self.both_alive = False
+
+    def play_round(self, move_1=None, move_2=None):
+        """
+        Resolves and applies the next round, with random moves by default
+
+        Returns:
+            tuple: (round_json, raw_response)
+        """
+        if move_1 is None or move_2 is None:
+            move_1, move_2 = self.choose_moves()
+        usage = None
+        with metrics.span('battle_round', engine=self.engine):
+            if self.engine == 'llm':
+                round_json, out, usage = self.resolve(move_1, move_2)
+            else:
+                round_json, out = local_round(self.battle_engine, self.p1, self.p2, self.state,
+                                              move_1, move_2, self.narrate)
+        self.apply(move_1, move_2, round_json, usage)
+        return round_json, out
+
+
+def run_battle(p1, p2, engine='local', narrate=False, seed=None, session=True, max_rounds=100):
+    """
+    Plays a battle with random moves until a player is knocked out, or
+    as a tie after max_rounds rounds
+
+    Args:
+        p1 (dict): Player1
+        p2 (dict): Player2
+        engine (str): 'local' resolves rounds with battle_engine, 'llm' asks jamba-large
+        narrate (bool): With the local engine, have the LLM narrate each round
+        seed (int): Seed for move choices and the local engine
+        session (bool): With the llm engine, send rounds through a
+            battle_session.BattleSession instead of rebuilding the whole
+            prompt every round
+        max_rounds (int): Rounds after which the battle is called a tie
+
+    Returns:
+        tuple: The final (p1, p2)
+    """
+    battle = Battle(p1, p2, engine=engine, narrate=narrate, seed=seed, session=session, max_rounds=max_rounds)
+
+    while battle.both_alive:
+        _, out = battle.play_round()
+        print(f'\n\n============= Round {battle.round_number} =============\n\n')
+        print(out)
+
+    print('\n\n============= RESULT =============\n\n')
+    if battle.winner:
+        print(f"{battle.winner} won!")
+    else:
+        print('It is a TIE')
+    if battle.session is not None:
+        print(f'Prompt tokens: {battle.session.stats()}')
+
+    return battle.p1, battle.p2
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate a battle between two example players")
+    parser.add_argument("--engine", choices=['local', 'llm'], default='local',
+                        help="Resolve rounds locally or with jamba-large (default: local)")
+    parser.add_argument("--narrate", action="store_true",
+                        help="Have the LLM narrate rounds resolved by the local engine")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed to replay the same battle")
+    parser.add_argument("--no-session", action="store_true",
+                        help="With the llm engine, rebuild the whole prompt every round")
+    args = parser.parse_args()
+    run_battle(p1, p2, engine=args.engine, narrate=args.narrate, seed=args.seed, session=not args.no_session)
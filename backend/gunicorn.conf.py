@@ -0,0 +1,63 @@
+"""
+Production serving config, run from the repository root:
+
+    gunicorn -c backend/gunicorn.conf.py
+
+Requests are served by pre-forked gunicorn workers, each running many
+threads, which is what the I/O-bound endpoints (provider calls, SSE
+streams, file downloads) need. CPU-bound stages don't run on those threads:
+every worker hands them to its own cpu_pool of CPU_WORKERS processes, which
+keep the background removal model loaded and use all cores.
+
+Jobs live in the memory of the worker that created them, so status, result
+and event lookups must reach that same worker. Keep WEB_WORKERS at 1 (the
+default) unless the proxy in front routes a client to the same worker.
+"""
+
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Split the cores between the CPU pools of all web workers
+_web_workers = int(os.getenv("WEB_WORKERS", "1"))
+os.environ.setdefault("CPU_WORKERS", str(max(1, multiprocessing.cpu_count() // _web_workers)))
+
+_backend_dir = os.path.dirname(os.path.abspath(__file__))
+# Relative outputs (./public, ARTIFACT_DIR, SPRITE_CACHE_DIR) resolve against
+# the repository root, where Next.js serves ./public from; the backend
+# modules are imported from backend/
+chdir = os.path.dirname(_backend_dir)
+pythonpath = _backend_dir
+wsgi_app = "flask_app:app"
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = _web_workers
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "32"))
+# SSE streams stay open for a whole generation; gthread workers heartbeat
+# from their main thread, so this only catches hung workers
+timeout = int(os.getenv("WEB_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+# The app starts its job threads at import, threads don't survive a fork,
+# so every worker imports the app itself
+preload_app = False
+accesslog = "-"
+
+
+def post_fork(server, worker):
+    import threading
+
+    import flask_app
+
+    if flask_app.WARMUP:
+        threading.Thread(target=flask_app.warm_up, name="warm-up", daemon=True).start()
+
+
+def worker_exit(server, worker):
+    import cpu_pool
+
+    cpu_pool.shutdown()
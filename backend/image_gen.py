@@ -1,19 +1,32 @@
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from PIL import Image
-from rembg import remove
 import requests
 import os
 import json
-from openai import OpenAI
+import re
 from dotenv import load_dotenv
+from artifacts import atomic_copy, atomic_save_image
+import cpu_pool
+import metrics
+import providers
+import resilience
+from sprite_cache import NO_BG, RAW, get_cache, sprite_key
 # Load environment variables
 load_dotenv()
 
-XAI_API_KEY = os.getenv("XAI_API_KEY")
-client = OpenAI(base_url="https://api.x.ai/v1", api_key=XAI_API_KEY)
+# How many grok-2-image calls run at once, and how long each may take (seconds)
+IMAGE_GEN_CONCURRENCY = int(os.getenv("IMAGE_GEN_CONCURRENCY", "3"))
+IMAGE_GEN_TIMEOUT = float(os.getenv("IMAGE_GEN_TIMEOUT", "90"))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "30"))
 
+IMAGE_MODEL = "grok-2-image"
+CHARACTER_STYLE = "Low resolution, 4-6 colors, background is white (character is not), bold outlines, no lines on the character itself, simplified design."
+BACKGROUND_STYLE = "Low resolution, pixelated, 4-6 colors maximum, bold outlines, no lines on elements (if any), simplified design."
 
-def generate_character_image(character_data):
+
+@resilience.resilient("xai", name="xai.images")
+def generate_character_image(character_data, timeout=None):
     name = character_data.get("Name", "Unknown Character")
     description = character_data.get("Character_Summary", "")
 
@@ -21,69 +34,145 @@ def generate_character_image(character_data):
 name: {name}
 description: {description}
 
-Style: Low resolution, 4-6 colors, background is white (character is not), bold outlines, no lines on the character itself, simplified design.
+Style: {CHARACTER_STYLE}
 Instructions: If a public figure, it should look like them."""
 
     print(prompt)
-    response = client.images.generate(
-        model="grok-2-image",
-        prompt=prompt,
-        n=1
-    )
+    client = providers.get_client("xai")
+    with providers.slot("xai"):
+        response = client.images.generate(
+            model=IMAGE_MODEL,
+            prompt=prompt,
+            n=1,
+            timeout=timeout or IMAGE_GEN_TIMEOUT
+        )
 
     return response.data[0].url
 
 
-def generate_background_image(bg_description):
+@resilience.resilient("xai", name="xai.images")
+def generate_background_image(bg_description, timeout=None):
     prompt = f"""Create a pixel art sprite of:
 
   description: {bg_description}
 
-  Style: Low resolution, pixelated, 4-6 colors maximum, bold outlines, no lines on elements (if any), simplified design.
+  Style: {BACKGROUND_STYLE}
   Instructions: No characters, no people, no animals, no objects, no text. Just a background with the specified description. Very simple. Not too busy.
   """
 
     print(prompt)
-    response = client.images.generate(
-        model="grok-2-image",
-        prompt=prompt,
-        n=1
-    )
+    client = providers.get_client("xai")
+    with providers.slot("xai"):
+        response = client.images.generate(
+            model=IMAGE_MODEL,
+            prompt=prompt,
+            n=1,
+            timeout=timeout or IMAGE_GEN_TIMEOUT
+        )
 
     return response.data[0].url
 
 
-def generate_images_from_json(json_file_path):
-    with open(json_file_path, 'r') as f:
-        data = json.load(f)
+def image_entries(data):
+    """
+    The entries of battle data that get an image: Character_N dicts and a
+    string Background. Anything else the model added (a topic, notes) is
+    left out.
+    """
+    entries = {}
+    for key, value in data.items():
+        if key == "Background" and isinstance(value, str):
+            entries[key] = value
+        elif re.fullmatch(r"Character[_ ]\d+", key) and isinstance(value, dict):
+            entries[key] = value
+    return entries
 
-    image_urls = {}
-    for char_key, char_data in data.items():
-        if char_key != "Background":
-            try:
-                image_url = generate_character_image(char_data)
-                image_urls[char_key] = image_url
-            except Exception as e:
-                print(f"Error generating image for {char_key}: {str(e)}")
+
+def sprite_cache_key(char_name, value):
+    """Cache key for the image of a battle entry, see sprite_cache.sprite_key."""
+    if char_name != "Background":
+        text = f'{value.get("Name", "Unknown Character")}\n{value.get("Character_Summary", "")}'
+        return sprite_key("character", text, IMAGE_MODEL, CHARACTER_STYLE)
+    return sprite_key("background", value, IMAGE_MODEL, BACKGROUND_STYLE)
+
+
+def _generate_image(key, value, timeout, on_image):
+    with metrics.span("image_generate", image=key):
+        if key != "Background":
+            url = generate_character_image(value, timeout=timeout)
         else:
+            url = generate_background_image(value, timeout=timeout)
+    if on_image is not None:
+        on_image(key, url)
+    return url
+
+
+def generate_images(data, concurrency=None, timeout=None, on_image=None):
+    """
+    Generates an image for every character and the background in battle data
+
+    The calls run on a bounded thread pool, so the total time is roughly that
+    of the slowest call. A failed call is logged and left out of the result
+    without affecting the others.
+
+    Args:
+        data (dict): Battle data with Character_N entries and a Background
+        concurrency (int): Maximum calls in flight (default: IMAGE_GEN_CONCURRENCY).
+            1 runs the calls one after another.
+        timeout (float): Per-call timeout in seconds (default: IMAGE_GEN_TIMEOUT)
+        on_image (callable): Optional on_image(key, url), called from the worker
+            thread as soon as each image is ready
+
+    Returns:
+        dict: Image URL per key, in the same order as data
+    """
+    concurrency = max(1, concurrency or IMAGE_GEN_CONCURRENCY)
+    timeout = timeout or IMAGE_GEN_TIMEOUT
+
+    image_urls = {}
+    with ThreadPoolExecutor(max_workers=min(concurrency, max(1, len(data)))) as pool:
+        futures = {key: metrics.submit(pool, _generate_image, key, value, timeout, on_image)
+                   for key, value in data.items()}
+        for key, future in futures.items():
             try:
-                bg_url = generate_background_image(char_data)
-                image_urls[char_key] = bg_url
+                image_urls[key] = future.result()
             except Exception as e:
-                print(f"Error generating background image: {str(e)}")
+                if key != "Background":
+                    print(f"Error generating image for {key}: {str(e)}")
+                else:
+                    print(f"Error generating background image: {str(e)}")
     return image_urls
 
 
+def generate_images_from_json(json_file_path, concurrency=None, timeout=None, on_image=None):
+    with open(json_file_path, 'r') as f:
+        data = json.load(f)
+
+    return generate_images(image_entries(data), concurrency=concurrency, timeout=timeout, on_image=on_image)
+
+
 # Function to download image from URL
 
-def download_image(url, save_path):
-    try:
-        # Send a GET request to the URL
-        response = requests.get(url)
+def fetch_image(url, timeout=None):
+    """
+    Downloads an image over the shared session and decodes it in memory
+
+    Returns:
+        PIL.Image.Image: The decoded image
+    """
+    with metrics.span("image_download") as span:
+        response = providers.http_session().get(url, timeout=timeout or DOWNLOAD_TIMEOUT)
         response.raise_for_status()  # Check if the request was successful
+        span.set_size(len(response.content))
 
-        # Open the image from the response content
         image = Image.open(BytesIO(response.content))
+        image.load()
+    return image
+
+
+def download_image(url, save_path):
+    try:
+        image = fetch_image(url)
         # Save the image locally
         image.save(save_path)
         print(f"Image successfully downloaded and saved as {save_path}")
@@ -96,32 +185,132 @@ def download_image(url, save_path):
         return False
 
 
-# # URL of the image to download
-# image_url = "https://imgen.x.ai/xai-imgen/xai-tmp-imgen-41a0d9ea-8dcb-4454-9a54-58a6d342cad6.jpeg"
-# input_path = "input.jpg"
-# output_path = "output.png"
+def process_image(char_name, url, output_dir="./public", keep_original=False, cache_key=None):
+    """
+    Downloads a generated image and writes its final PNG
 
-def main(json_file="./battle.json"):
-    character_images = generate_images_from_json(json_file)
+    Character images go from memory straight into background removal and only
+    {char_name}_no_bg.png is written, plus the raw {char_name}.png when
+    keep_original is set. The background is written as {char_name}.png.
+    With a cache_key the raw and processed images are also stored in the
+    sprite cache.
 
-    for char_name, url in character_images.items():
-        save_path = f"./public/{char_name}.png"
-        output_path = f"./public/{char_name}_no_bg.png"
-        if download_image(url, save_path) and char_name != "Background":
-            # Process the downloaded image to remove background
+    Returns:
+        str: Path of the final image
+    """
+    cache = get_cache() if cache_key else None
+    image = fetch_image(url)
+    if cache is not None:
+        cache.put(cache_key, image, RAW)
+
+    if char_name == "Background":
+        save_path = os.path.join(output_dir, f"{char_name}.png")
+        atomic_save_image(image, save_path)
+        print(f"Image successfully downloaded and saved as {save_path}")
+        return save_path
+
+    if keep_original:
+        atomic_save_image(image, os.path.join(output_dir, f"{char_name}.png"))
+
+    output_path = os.path.join(output_dir, f"{char_name}_no_bg.png")
+    with metrics.span("bg_remove", image=char_name):
+        output_image = cpu_pool.remove_background(image)
+    atomic_save_image(output_image, output_path)
+    if cache is not None:
+        cache.put(cache_key, output_image, NO_BG)
+    print(f"Background removed and image saved as {output_path}")
+    return output_path
+
+
+def restore_cached_image(char_name, cache_key, output_dir="./public", keep_original=False):
+    """
+    Copies a cached image to its output path without decoding it
+
+    Returns:
+        str: Path of the final image, or None when the cache has no complete entry
+    """
+    cache = get_cache()
+    if cache is None:
+        return None
+
+    if char_name == "Background":
+        variants = (RAW,)
+    elif keep_original:
+        variants = (RAW, NO_BG)
+    else:
+        variants = (NO_BG,)
+    entry = cache.get(cache_key, variants)
+    if entry is None:
+        return None
+
+    if char_name == "Background":
+        final_path = os.path.join(output_dir, f"{char_name}.png")
+        atomic_copy(entry[RAW], final_path)
+        return final_path
+
+    if keep_original:
+        atomic_copy(entry[RAW], os.path.join(output_dir, f"{char_name}.png"))
+    final_path = os.path.join(output_dir, f"{char_name}_no_bg.png")
+    atomic_copy(entry[NO_BG], final_path)
+    return final_path
+
+
+def main(json_file="./battle.json", keep_originals=False, output_dir="./public"):
+    """
+    Generates, downloads and post-processes every image for a battle file
+
+    Images found in the sprite cache are copied into place directly. The rest
+    are downloaded and have their background removed as soon as their
+    generation call returns, while the other generations are still running.
+
+    Returns:
+        dict: Path of the final image per key
+    """
+    with open(json_file, 'r') as f:
+        data = image_entries(json.load(f))
+
+    final_paths = {}
+    cache_keys = {}
+    missing = {}
+    for char_name, value in data.items():
+        cached_path = None
+        try:
+            cache_keys[char_name] = sprite_cache_key(char_name, value)
+            cached_path = restore_cached_image(char_name, cache_keys[char_name], output_dir, keep_originals)
+        except (OSError, ValueError, AttributeError) as e:
+            # e.g. the entry was evicted while it was being copied
+            print(f"{char_name}: sprite cache lookup failed, generating it instead: {e}")
+        if cached_path is not None:
+            print(f"{char_name}: cache hit, saved as {cached_path}")
+            final_paths[char_name] = cached_path
+        else:
+            missing[char_name] = value
+
+    if not missing:
+        return final_paths
+
+    with ThreadPoolExecutor(max_workers=IMAGE_GEN_CONCURRENCY) as pool:
+        pending = {}
+
+        def on_image(char_name, url):
+            pending[char_name] = metrics.submit(pool, process_image, char_name, url, output_dir, keep_originals,
+                                                cache_keys.get(char_name))
+
+        character_images = generate_images(missing, on_image=on_image)
+
+        for char_name, future in pending.items():
             try:
-                input_image = Image.open(save_path)
-                output_image = remove(input_image)
-                output_image.save(output_path)
-                print(f"Background removed and image saved as {output_path}")
+                final_paths[char_name] = future.result()
+            except requests.exceptions.RequestException as e:
+                print(f"Error downloading image for {char_name}: {e}")
             except Exception as e:
-                print(f"Error removing background: {e}")
-        else:
-            print("Failed to download image, cannot proceed with background removal")
+                print(f"Error processing image for {char_name}: {e}")
 
     for char_name, url in character_images.items():
         print(f"{char_name}: {url}")
 
+    return {char_name: final_paths[char_name] for char_name in data if char_name in final_paths}
+
 
 if __name__ == "__main__":
     json_file = "backend/rapper_example.json"
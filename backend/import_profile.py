@@ -0,0 +1,64 @@
+"""
+Import-time profile of a backend module.
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter and
+reports the slowest imports by cumulative time, so heavy dependencies that
+creep back into the boot path are easy to spot.
+
+    python import_profile.py flask_app --top 15 --budget 1.0
+
+Exits with status 1 when the total import time is over --budget seconds.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def profile(module, python=None):
+    """
+    Imports a module in a new interpreter with -X importtime
+
+    Returns:
+        list: (cumulative_us, self_us, depth, name) for every imported module,
+        in import order
+    """
+    result = subprocess.run([python or sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    rows = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((int(cumulative_us), int(self_us), len(indent) // 2, name))
+    return rows
+
+
+def report(module, rows, top=20):
+    """Formats the total and the top slowest imports of a profile."""
+    total = next((cumulative for cumulative, _, _, name in rows if name == module), 0)
+    lines = [f"import {module}: {total / 1e6:.3f}s, {len(rows)} modules", "",
+             f"{'cumulative':>12} {'self':>10}  module"]
+    for cumulative, self_us, depth, name in sorted(rows, reverse=True)[:top]:
+        lines.append(f"{cumulative / 1e3:>10.1f}ms {self_us / 1e3:>8.1f}ms  {'  ' * depth}{name}")
+    return "\n".join(lines), total / 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("module", nargs="?", default="flask_app")
+    parser.add_argument("--top", type=int, default=20, help="Number of slowest imports to list")
+    parser.add_argument("--budget", type=float, help="Fail when the import takes longer (seconds)")
+    args = parser.parse_args()
+
+    text, seconds = report(args.module, profile(args.module), args.top)
+    print(text)
+    if args.budget is not None and seconds > args.budget:
+        print(f"\nOver budget: {seconds:.3f}s > {args.budget:.3f}s")
+        sys.exit(1)
@@ -0,0 +1,183 @@
+"""
+Background job queue for long-running generation requests.
+
+Jobs are run by a fixed pool of worker threads that pull from a bounded
+queue. When the queue is full, submit() raises QueueFull instead of piling
+up more work, so the web layer can answer with 429.
+"""
+
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFull(Exception):
+    """Raised when the job queue has no room for another job."""
+
+
+class Job:
+    """
+    A single unit of work tracked by the JobQueue.
+
+    The job function receives the Job itself so it can report which stage
+    of the pipeline it is in. Every change is also recorded as an event,
+    which is what the SSE endpoint streams to the client.
+    """
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = QUEUED
+        self.stage = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._events = []
+        self._cond = threading.Condition()
+        self._emit("status", {"status": QUEUED})
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def set_stage(self, stage):
+        """Record the pipeline stage the job has entered."""
+        self.stage = stage
+        self._emit("stage", {"stage": stage})
+
+    def _start(self):
+        self.status = RUNNING
+        self.started_at = time.time()
+        self._emit("status", {"status": RUNNING})
+
+    def _finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.status = FAILED if error is not None else DONE
+        self.finished_at = time.time()
+        self._emit("status", self.to_dict())
+
+    def _emit(self, event, data):
+        with self._cond:
+            self._events.append((event, data))
+            self._cond.notify_all()
+
+    def iter_events(self, keepalive=15):
+        """
+        Yields (event, data) pairs from the start of the job until it finishes.
+
+        If nothing happens for `keepalive` seconds a ("ping", None) pair is
+        yielded so callers can keep the connection open.
+        """
+        index = 0
+        while True:
+            with self._cond:
+                if index >= len(self._events) and not self.finished:
+                    self._cond.wait(keepalive)
+                pending = self._events[index:]
+                index += len(pending)
+                finished = self.finished
+            if not pending:
+                if finished:
+                    return
+                yield "ping", None
+            for event, data in pending:
+                yield event, data
+            if finished and index >= len(self._events):
+                return
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "stage": self.stage,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """
+    Bounded queue of jobs served by a fixed number of worker threads.
+
+    Args:
+        workers (int): Number of worker threads running jobs
+        max_queued (int): Jobs allowed to wait for a worker before submit() fails
+        max_finished (int): Finished jobs kept around for status lookups
+    """
+
+    def __init__(self, workers=2, max_queued=8, max_finished=100):
+        self.max_finished = max_finished
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, name, fn, *args, **kwargs):
+        """
+        Queues fn(job, *args, **kwargs) and returns the Job right away.
+
+        Raises:
+            QueueFull: If max_queued jobs are already waiting
+        """
+        job = Job(name)
+        with self._lock:
+            try:
+                self._queue.put_nowait((job, fn, args, kwargs))
+            except queue.Full:
+                raise QueueFull(f"{self._queue.maxsize} jobs already waiting")
+            self._jobs[job.id] = job
+            self._forget_old()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "workers": len(self._threads),
+            "queued": self._queue.qsize(),
+            "capacity": self._queue.maxsize,
+            "jobs": counts,
+        }
+
+    def _forget_old(self):
+        # Only finished jobs are dropped; queued and running ones stay visible
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def _worker(self):
+        while True:
+            job, fn, args, kwargs = self._queue.get()
+            job._start()
+            try:
+                result = fn(job, *args, **kwargs)
+            except Exception as e:
+                print(f"Job {job.id} failed: {e}")
+                job._finish(error=str(e))
+            else:
+                job._finish(result=result)
+            finally:
+                self._queue.task_done()
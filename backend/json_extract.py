@@ -0,0 +1,255 @@
+"""
+Tolerant JSON extraction for LLM responses.
+
+Models wrap their JSON in code fences or chatter, leave trailing commas, use
+smart quotes and write numbers as strings ("Damage": "40"). Instead of
+retrying the whole request, extract_json() finds the first complete JSON
+object in the text and repairs those defects, and the validate_* helpers
+check it against the battle and round schemas.
+"""
+
+import json
+import re
+
+BATTLE_CHARACTER_KEYS = ("Character_1", "Character_2")
+MOVE_KEYS = ("Move_1", "Move_2", "Move_3", "Move_4")
+ROUND_NUMBER_KEYS = ("effectiveness_1", "damage_1", "effectiveness_2", "damage_2")
+
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_NUMBER = re.compile(r"-?\d+(\.\d+)?")
+_SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "„": '"', "″": '"',
+                               "‘": "'", "’": "'"})
+
+
+class JSONExtractionError(ValueError):
+    """Raised when no usable JSON object can be recovered from a response."""
+
+
+class SchemaError(ValueError):
+    """Raised when extracted JSON does not match the expected schema."""
+
+
+class JsonExtractor:
+    """
+    Finds the first complete top-level JSON object in streamed text.
+
+    feed() returns the object text once its closing brace arrives, so a
+    streaming caller can stop reading there.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._started = False
+        self.result = None
+
+    @property
+    def done(self):
+        return self.result is not None
+
+    def feed(self, text):
+        """Adds text, returning the complete object text or None."""
+        if self.done:
+            return self.result
+        if not self._started:
+            start = text.find("{")
+            if start < 0:
+                return None
+            self._started = True
+            text = text[start:]
+        return self._scan(text)
+
+    def _scan(self, text):
+        for i, char in enumerate(text):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._chunks.append(text[:i + 1])
+                    self.result = "".join(self._chunks)
+                    return self.result
+        self._chunks.append(text)
+        return None
+
+
+def first_object(text):
+    """Returns the text of the first complete JSON object in text, or None."""
+    extractor = JsonExtractor()
+    return extractor.feed(text)
+
+
+def iter_objects(text, limit=20):
+    """Yields the text of each balanced {...} candidate, by position of its opening brace."""
+    start = text.find("{")
+    while start >= 0 and limit > 0:
+        candidate = first_object(text[start:])
+        if candidate is None:
+            return
+        yield candidate
+        limit -= 1
+        start = text.find("{", start + 1)
+
+
+def _loads(candidate):
+    # strict=False accepts raw newlines inside strings
+    return json.loads(candidate, strict=False)
+
+
+def repair_candidates(candidate):
+    """Yields increasingly repaired versions of an object's text."""
+    yield candidate
+    without_commas = _TRAILING_COMMA.sub(r"\1", candidate)
+    yield without_commas
+    yield re.sub(r"\bTrue\b", "true", re.sub(r"\bFalse\b", "false",
+                 re.sub(r"\bNone\b", "null", without_commas)))
+
+
+def extract_json(text):
+    """
+    Recovers the first JSON object from an LLM response
+
+    Args:
+        text (str): Raw response, possibly fenced or surrounded by prose
+
+    Returns:
+        dict: The parsed object
+
+    Raises:
+        JSONExtractionError: If no object could be parsed
+    """
+    if not isinstance(text, str):
+        raise JSONExtractionError(f"Expected text, got {type(text).__name__}")
+
+    # Smart quotes may be delimiters or part of the prose inside strings, so
+    # they are only normalized when the text does not parse as it is
+    last_error = None
+    for source in (text, text.translate(_SMART_QUOTES)):
+        for candidate in iter_objects(source):
+            for repaired in repair_candidates(candidate):
+                try:
+                    data = _loads(repaired)
+                except ValueError as e:
+                    last_error = e
+                    continue
+                if isinstance(data, dict):
+                    return data
+    if last_error is not None:
+        raise JSONExtractionError(f"Could not parse JSON: {last_error}")
+    raise JSONExtractionError("No JSON object found")
+
+
+def to_number(value):
+    """Turns numeric strings like "40" or " 12.5 " into numbers, leaves anything else."""
+    if isinstance(value, str) and _NUMBER.fullmatch(value.strip()):
+        number = float(value)
+        return int(number) if number.is_integer() else number
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def normalize_battle_keys(data):
+    """Maps the "Character 1" style keys used by web_search to "Character_1"."""
+    return {re.sub(r"^Character\s+(\d+)$", r"Character_\1", key): value for key, value in data.items()}
+
+
+def validate_battle(data):
+    """
+    Checks a generated battle against the character schema
+
+    Numeric strings in Damage and HP are converted to numbers.
+
+    Returns:
+        dict: The normalized battle
+
+    Raises:
+        SchemaError: Listing every problem found
+    """
+    if not isinstance(data, dict):
+        raise SchemaError("Battle must be a JSON object")
+    data = normalize_battle_keys(data)
+
+    problems = []
+    for char_key in BATTLE_CHARACTER_KEYS:
+        character = data.get(char_key)
+        if not isinstance(character, dict):
+            problems.append(f"{char_key} is missing")
+            continue
+        for field in ("Name", "Character_Summary"):
+            if not isinstance(character.get(field), str) or not character[field].strip():
+                problems.append(f"{char_key}.{field} is missing")
+        if "HP" in character:
+            character["HP"] = to_number(character["HP"])
+            if not isinstance(character["HP"], (int, float)):
+                problems.append(f"{char_key}.HP is not a number")
+        moves = character.get("Moves")
+        if not isinstance(moves, dict):
+            problems.append(f"{char_key}.Moves is missing")
+            continue
+        for move_key in MOVE_KEYS:
+            move = moves.get(move_key)
+            if not isinstance(move, dict):
+                problems.append(f"{char_key}.Moves.{move_key} is missing")
+                continue
+            for field in ("Move_name", "Description"):
+                if not isinstance(move.get(field), str):
+                    problems.append(f"{char_key}.Moves.{move_key}.{field} is missing")
+            move["Damage"] = to_number(move.get("Damage"))
+            if not isinstance(move["Damage"], (int, float)):
+                problems.append(f"{char_key}.Moves.{move_key}.Damage is not a number")
+
+    if "Background" in data and not isinstance(data["Background"], str):
+        problems.append("Background is not a string")
+
+    if problems:
+        raise SchemaError("; ".join(problems))
+    return data
+
+
+def validate_round(data):
+    """
+    Checks a battle round returned by the LLM
+
+    Returns:
+        dict: The round with numeric fields converted to numbers
+
+    Raises:
+        SchemaError: If a field is missing or not a number
+    """
+    if not isinstance(data, dict):
+        raise SchemaError("Round must be a JSON object")
+    problems = []
+    for key in ROUND_NUMBER_KEYS:
+        if key not in data:
+            problems.append(f"{key} is missing")
+            continue
+        data[key] = to_number(data[key])
+        if not isinstance(data[key], (int, float)):
+            problems.append(f"{key} is not a number")
+    if "summary" not in data:
+        problems.append("summary is missing")
+    if problems:
+        raise SchemaError("; ".join(problems))
+    return data
+
+
+def extract_battle(text):
+    """extract_json() followed by validate_battle()."""
+    return validate_battle(extract_json(text))
+
+
+def extract_round(text):
+    """extract_json() followed by validate_round()."""
+    return validate_round(extract_json(text))
@@ -2,11 +2,25 @@
 """
 Main script for generating battle simulations by using the gamify.py module.
 This script serves as an entry point to demonstrate how to use the battle query generator.
+
+With --batch it runs the whole pipeline (battle JSON + sprites) for every
+topic in a file, or stdin with "-", in one process with bounded concurrency.
+Each finished topic is appended to a JSONL manifest with its outputs and
+timings, and topics already done in the manifest are skipped, so an
+interrupted batch resumes where it stopped:
+
+    python main.py --batch topics.txt --concurrency 4 --output-dir ./batch
 """
 
 import os
+import re
 import sys
+import json
+import time
+import hashlib
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 
 # Import functions from gamify.py
@@ -27,12 +41,214 @@ def parse_arguments():
                         help="OpenAI model to use (default: gpt-4-turbo)")
     parser.add_argument("--skip-images", action="store_true",
                         help="Skip image generation step")
+    parser.add_argument("--batch", type=str, default=None,
+                        help="File with one topic per line, or - for stdin")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Topics generated at the same time in batch mode (default: 4)")
+    parser.add_argument("--output-dir", type=str, default="./batch",
+                        help="Directory for the per-topic outputs in batch mode (default: ./batch)")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="JSONL manifest in batch mode (default: [output-dir]/manifest.jsonl)")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Run topics that failed in an earlier batch again")
+    parser.add_argument("--archive", type=str, default=None,
+                        help="Also pack every finished battle of the batch into this .npz archive")
     return parser.parse_args()
 
+
+def read_topics(source):
+    """Yields the distinct, non-empty topics of a file or stdin ("-"), one per line."""
+    from battle_cache import normalize_topic
+
+    stream = sys.stdin if source == "-" else open(source, "r", encoding="utf-8")
+    seen = set()
+    try:
+        for line in stream:
+            topic = line.strip()
+            if not topic or topic.startswith("#"):
+                continue
+            key = normalize_topic(topic)
+            if key not in seen:
+                seen.add(key)
+                yield topic
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def topic_dir_name(topic):
+    """Directory name for a topic: a readable slug plus a hash so similar topics don't collide."""
+    from battle_cache import normalize_topic
+
+    key = normalize_topic(topic)
+    slug = re.sub(r"[^a-z0-9]+", "_", key).strip("_")[:60] or "topic"
+    return f"{slug}-{hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]}"
+
+
+def load_manifest(path):
+    """Returns normalized topic -> last manifest entry, skipping a torn last line."""
+    from battle_cache import normalize_topic
+
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[normalize_topic(entry.get("topic", ""))] = entry
+    return entries
+
+
+class Manifest:
+    """Append-only JSONL manifest, each line is flushed to disk before the next topic counts as done."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, entry):
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def generate_topic(topic, output_dir, skip_images=False):
+    """Runs the whole pipeline for one topic, returns its manifest entry."""
+    import metrics
+    from image_gen import image_entries
+    from web_search_maestro import generate_battle
+
+    topic_dir = os.path.join(output_dir, topic_dir_name(topic))
+    os.makedirs(topic_dir, exist_ok=True)
+    entry = {"topic": topic, "output_dir": topic_dir}
+    with metrics.trace() as trace:
+        try:
+            result = generate_battle(topic, output_dir=topic_dir, images=not skip_images)
+        except Exception as e:
+            entry.update(status="failed", error=f"{type(e).__name__}: {e}")
+        else:
+            entry.update(status="done", route=result["route"], cached=result["cached"],
+                         battle_file=result["battle_file"], images=result["images"],
+                         sprites=result["sprites"])
+            missing = [key for key in image_entries(result["battle"])
+                       if not skip_images and key not in result["images"]]
+            if missing:
+                # Counted as failed so --retry-failed picks the topic up again
+                entry.update(status="failed", error=f"No image for {', '.join(missing)}")
+    breakdown = trace.breakdown()
+    entry["timings"] = {"total": breakdown["total"], "stages": breakdown["stages"]}
+    entry["finished_at"] = time.time()
+    return entry
+
+
+def run_batch(source, output_dir="./batch", manifest_path=None, concurrency=4, skip_images=False,
+              retry_failed=False):
+    """
+    Generates every topic of a file or stdin, resuming from the manifest
+
+    Topics are read lazily, so at most about 2 x concurrency of them are in
+    memory at once and a long stdin stream starts right away.
+
+    Returns:
+        dict: Counts of done, failed and skipped topics and the wall time
+    """
+    from battle_cache import normalize_topic
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = manifest_path or os.path.join(output_dir, "manifest.jsonl")
+    previous = load_manifest(manifest_path)
+    manifest = Manifest(manifest_path)
+    counts = {"done": 0, "failed": 0, "skipped": 0}
+    counts_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(max(1, concurrency) * 2)
+
+    def run(topic):
+        try:
+            entry = generate_topic(topic, output_dir, skip_images)
+            manifest.append(entry)
+            with counts_lock:
+                counts[entry["status"]] += 1
+            if entry["status"] == "done":
+                print(f"[done] {topic} in {entry['timings']['total']:.1f}s")
+            else:
+                print(f"[failed] {topic}: {entry['error']}")
+        finally:
+            slots.release()
+
+    def report(future, topic):
+        # run() itself failed, e.g. writing the manifest or the topic directory
+        error = future.exception()
+        if error is not None:
+            with counts_lock:
+                counts["failed"] += 1
+            print(f"[failed] {topic}: {type(error).__name__}: {error}")
+
+    start = time.perf_counter()
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for topic in read_topics(source):
+            entry = previous.get(normalize_topic(topic))
+            if entry is not None and (entry.get("status") == "done" or not retry_failed):
+                counts["skipped"] += 1
+                continue
+            slots.acquire()
+            futures[pool.submit(run, topic)] = topic
+            # Only the topics in flight are kept
+            for future in [future for future in futures if future.done()]:
+                report(future, futures.pop(future))
+        for future in as_completed(futures):
+            report(future, futures[future])
+    counts["seconds"] = round(time.perf_counter() - start, 1)
+    counts["manifest"] = manifest_path
+    return counts
+
+
+def archive_batch(manifest_path, archive_path):
+    """
+    Packs the battles of every done topic in a manifest into a columnar archive
+
+    Returns:
+        int: Number of battles packed
+    """
+    from battle_schema import load_battle_file, save_archive
+
+    records = []
+    for entry in load_manifest(manifest_path).values():
+        if entry.get("status") != "done":
+            continue
+        try:
+            records.append(load_battle_file(entry["battle_file"]))
+        except (KeyError, OSError, ValueError) as e:
+            print(f"Not archiving {entry['topic']}: {e}")
+    save_archive(records, archive_path)
+    return len(records)
+
+
 def main():
     """Main function to run the battle generation process."""
     # Load environment variables
     load_dotenv()
+
+    # Parse command line arguments
+    args = parse_arguments()
+
+    if args.batch:
+        # The batch pipeline routes between Maestro, ChatGPT and jamba, so it
+        # doesn't need the OpenAI key in particular
+        summary = run_batch(args.batch, args.output_dir, args.manifest, args.concurrency,
+                            args.skip_images, args.retry_failed)
+        print(f"Batch finished: {summary['done']} done, {summary['failed']} failed, "
+              f"{summary['skipped']} skipped in {summary['seconds']}s. Manifest: {summary['manifest']}")
+        if args.archive:
+            packed = archive_batch(summary["manifest"], args.archive)
+            print(f"Archived {packed} battles to {args.archive}")
+        return 1 if summary["failed"] else 0
     
     # Check for API key
     if not os.getenv('OPENAI_API_KEY'):
@@ -45,9 +261,6 @@ def main():
         print("Warning: No X.AI API key found. Image generation will not work.")
         print("Add XAI_API_KEY=your_api_key_here to your .env file for image generation.")
     
-    # Parse command line arguments
-    args = parse_arguments()
-    
     # Use command line topic or prompt user
     topic = args.topic
     if not topic:
@@ -84,6 +297,7 @@ def main():
                 os.makedirs("./images", exist_ok=True)
                 
                 # Generate images for characters
+                from image_gen import generate_images_from_json
                 character_images = generate_images_from_json(filename)
                 
                 print("\nCharacter images generated successfully!")
@@ -0,0 +1,273 @@
+"""
+Stage spans and Prometheus metrics.
+
+Each pipeline stage runs inside span(stage), which measures its duration and
+optionally the size in bytes of what it produced and how many times its
+provider call was retried. Every span is recorded in process-wide
+histograms exported in the Prometheus text format by render() (served at
+/metrics), and in the Trace of the job it belongs to, whose breakdown() is
+added to the job result.
+
+The current trace is kept in a contextvar. Thread pools do not carry
+contextvars over to their workers, so work belonging to a job has to be
+submitted with submit() instead of executor.submit().
+"""
+
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+SIZE_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7)
+TOKEN_BUCKETS = (250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 16000)
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+_current_span = contextvars.ContextVar("span", default=None)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (list(extra.items()) if extra else [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> [bucket counts, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = {"le": _format_value(bound) if bound == math.inf else repr(float(bound))}
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+STAGE_DURATION = Histogram("battle_stage_duration_seconds", "Duration of a pipeline stage", ("stage",))
+STAGE_BYTES = Histogram("battle_stage_bytes", "Size of what a pipeline stage produced", ("stage",), SIZE_BUCKETS)
+STAGE_ERRORS = Counter("battle_stage_errors_total", "Pipeline stages that raised", ("stage",))
+PROVIDER_RETRIES = Counter("provider_retries_total", "Provider requests that were retried", ("operation",))
+PROVIDER_HEDGES = Counter("provider_hedges_total", "Duplicate provider requests started past p95", ("operation",))
+BG_REMOVALS = Counter("bg_removals_total", "Background removals by method (fast path or rembg)", ("method",))
+BATTLE_PROMPT_TOKENS = Histogram("battle_round_prompt_tokens", "Prompt tokens of a battle session round", (),
+                                 TOKEN_BUCKETS)
+SPECULATIONS = Counter("battle_speculations_total",
+                       "Speculative round requests by outcome (hit, miss, cancelled, wasted)", ("outcome",))
+
+REGISTRY = [STAGE_DURATION, STAGE_BYTES, STAGE_ERRORS, PROVIDER_RETRIES, PROVIDER_HEDGES, BG_REMOVALS,
+            BATTLE_PROMPT_TOKENS, SPECULATIONS]
+
+
+class Span:
+    """One timed stage. size and retries can be set while it runs."""
+
+    def __init__(self, stage, trace=None, **labels):
+        self.stage = stage
+        self.labels = labels
+        self.trace = trace
+        self.start = time.perf_counter()
+        self.duration = None
+        self.size = None
+        self.retries = 0
+        self.error = None
+
+    def set_size(self, size):
+        self.size = size
+
+    def to_dict(self):
+        data = {"stage": self.stage, "seconds": round(self.duration or 0.0, 4)}
+        if self.trace is not None:
+            data["start"] = round(self.start - self.trace.start, 4)
+        if self.size is not None:
+            data["bytes"] = self.size
+        if self.retries:
+            data["retries"] = self.retries
+        if self.error:
+            data["error"] = self.error
+        if self.labels:
+            data.update(self.labels)
+        return data
+
+
+class Trace:
+    """Every span recorded while the trace was current, e.g. one generation job."""
+
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.end = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def merge(self, other):
+        """Adds the spans recorded so far in another trace, see submit_detached()."""
+        with other._lock:
+            spans = list(other.spans)
+        with self._lock:
+            self.spans.extend(spans)
+
+    def breakdown(self):
+        """
+        Returns:
+            dict: Total seconds, per-stage totals and every span in start order
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        stages = {}
+        for span in spans:
+            totals = stages.setdefault(span.stage, {"count": 0, "seconds": 0.0, "bytes": 0, "retries": 0})
+            totals["count"] += 1
+            totals["seconds"] += span.duration or 0.0
+            totals["bytes"] += span.size or 0
+            totals["retries"] += span.retries
+        for totals in stages.values():
+            totals["seconds"] = round(totals["seconds"], 4)
+        end = self.end or time.perf_counter()
+        return {"total": round(end - self.start, 4), "stages": stages,
+                "spans": [span.to_dict() for span in spans]}
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def trace():
+    """Makes a new Trace current for the block and yields it."""
+    current = Trace()
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        current.end = time.perf_counter()
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(stage, **labels):
+    """
+    Times a stage and records it in the histograms and the current trace
+
+    Extra labels are only kept in the trace, the histograms are labelled by
+    stage alone to keep their cardinality fixed.
+    """
+    current = Span(stage, _current_trace.get(), **labels)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.duration = time.perf_counter() - current.start
+        STAGE_DURATION.observe(current.duration, stage=stage)
+        if current.size is not None:
+            STAGE_BYTES.observe(current.size, stage=stage)
+        if current.trace is not None:
+            current.trace.add(current)
+
+
+def record_retry(operation):
+    """Counts a retry of a provider operation, on the current span too."""
+    PROVIDER_RETRIES.inc(operation=operation)
+    current = _current_span.get()
+    if current is not None:
+        current.retries += 1
+
+
+def record_hedge(operation):
+    PROVIDER_HEDGES.inc(operation=operation)
+
+
+def submit(executor, fn, *args, **kwargs):
+    """executor.submit() that runs fn in a copy of the caller's context, keeping its trace."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def submit_detached(executor, fn, *args, **kwargs):
+    """
+    submit() with fn's spans going to a trace of their own
+
+    For work whose result may go unused and that may outlive the caller's
+    trace. Merge the returned trace into the caller's once the result is used.
+
+    Returns:
+        tuple: (future, Trace)
+    """
+    parent = _current_trace.get()
+    detached = Trace(start=parent.start if parent is not None else None)
+    context = contextvars.copy_context()
+    context.run(_current_trace.set, detached)
+    return executor.submit(context.run, fn, *args, **kwargs), detached
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,205 @@
+"""
+Shared provider clients for every generation stage.
+
+Clients for x.ai (grok-2-image), OpenAI and AI21 are created once per
+process on first use, on top of keep-alive connection pools (HTTP/2 when
+the h2 package is installed). Each provider has a concurrency limit that all
+threads share, and call()/acall() give a sync and an asyncio interface over
+the same clients.
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+PROVIDER_TIMEOUT = float(os.getenv("PROVIDER_TIMEOUT", "120"))
+PROVIDER_CONNECT_TIMEOUT = float(os.getenv("PROVIDER_CONNECT_TIMEOUT", "10"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+PROVIDER_HTTP2 = os.getenv("PROVIDER_HTTP2", "1") == "1"
+
+# name -> client settings; the concurrency limit can be overridden with
+# e.g. PROVIDER_XAI_CONCURRENCY=8
+PROVIDERS = {
+    "xai": {"kind": "openai", "base_url": "https://api.x.ai/v1", "api_key_env": "XAI_API_KEY", "concurrency": 4},
+    "openai": {"kind": "openai", "base_url": None, "api_key_env": "OPENAI_API_KEY", "concurrency": 4},
+    "ai21": {"kind": "ai21", "base_url": None, "api_key_env": "AI21_API_KEY", "concurrency": 4},
+}
+
+# Slots limited apart from their provider's other requests, as slot(name).
+# A Maestro run holds its slot while it polls for minutes, so it must not
+# take the slots jamba rounds and streams need. Overridden the same way,
+# e.g. PROVIDER_AI21_MAESTRO_CONCURRENCY=4
+SLOTS = {
+    "ai21_maestro": {"concurrency": 2},
+}
+
+_clients = {}
+_http_clients = []
+_limits = {}
+_session = None
+_lock = threading.Lock()
+
+
+def _http2_available():
+    if not PROVIDER_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _settings(name):
+    try:
+        return PROVIDERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown provider: {name}")
+
+
+def concurrency_limit(name):
+    default = SLOTS[name]["concurrency"] if name in SLOTS else _settings(name)["concurrency"]
+    return int(os.getenv(f"PROVIDER_{name.upper()}_CONCURRENCY", str(default)))
+
+
+def _http_client_kwargs():
+    import httpx
+
+    return {
+        "limits": httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE,
+                               keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+        "timeout": httpx.Timeout(PROVIDER_TIMEOUT, connect=PROVIDER_CONNECT_TIMEOUT),
+        "http2": _http2_available(),
+    }
+
+
+def _create_client(name):
+    settings = _settings(name)
+    api_key = os.getenv(settings["api_key_env"])
+
+    if settings["kind"] == "ai21":
+        import httpx
+        from ai21 import AI21Client
+
+        http_client = httpx.Client(**_http_client_kwargs())
+        _http_clients.append(http_client)
+        return AI21Client(api_key=api_key, timeout_sec=PROVIDER_TIMEOUT, http_client=http_client)
+
+    import openai
+
+    http_client = openai.DefaultHttpxClient(**_http_client_kwargs())
+    _http_clients.append(http_client)
+    kwargs = {"api_key": api_key, "http_client": http_client}
+    if settings["base_url"]:
+        kwargs["base_url"] = settings["base_url"]
+    return openai.OpenAI(**kwargs)
+
+
+def get_client(name):
+    """Returns the shared client for a provider ("xai", "openai" or "ai21")."""
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _create_client(name)
+                _clients[name] = client
+    return client
+
+
+def _limit(name):
+    semaphore = _limits.get(name)
+    if semaphore is None:
+        with _lock:
+            semaphore = _limits.get(name)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(concurrency_limit(name))
+                _limits[name] = semaphore
+    return semaphore
+
+
+@contextmanager
+def slot(name):
+    """Holds one of the concurrent request slots of a provider or of a SLOTS entry."""
+    semaphore = _limit(name)
+    semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def call(name, fn, *args, **kwargs):
+    """Runs fn(client, *args, **kwargs) within the provider's concurrency limit."""
+    client = get_client(name)
+    with slot(name):
+        return fn(client, *args, **kwargs)
+
+
+async def acall(name, fn, *args, **kwargs):
+    """asyncio version of call(); the request runs on a worker thread."""
+    import asyncio
+
+    return await asyncio.to_thread(call, name, fn, *args, **kwargs)
+
+
+def http_session():
+    """Shared keep-alive requests.Session for plain HTTP calls and downloads."""
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        with _lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def http_timeout():
+    """(connect, read) timeout for http_session() requests."""
+    return (PROVIDER_CONNECT_TIMEOUT, PROVIDER_TIMEOUT)
+
+
+@contextmanager
+def replace(clients, session=None):
+    """
+    Serves the given clients (name -> client) and session instead of the real
+    ones inside the block, e.g. to replay recorded responses in benchmarks
+    """
+    global _session
+    with _lock:
+        saved = dict(_clients), _session
+        _clients.update(clients)
+        if session is not None:
+            _session = session
+    try:
+        yield
+    finally:
+        with _lock:
+            _clients.clear()
+            _clients.update(saved[0])
+            _session = saved[1]
+
+
+def close():
+    """Closes every client and the shared session."""
+    global _session
+    with _lock:
+        for http_client in _http_clients:
+            http_client.close()
+        _http_clients.clear()
+        _clients.clear()
+        if _session is not None:
+            _session.close()
+            _session = None
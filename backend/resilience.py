@@ -0,0 +1,394 @@
+"""
+Retry, hedging and circuit breaking for provider calls.
+
+Wrap a function that makes one provider request with @resilient(provider):
+
+- transient failures (timeouts, connection errors, 408/429/5xx) are retried
+  with exponential backoff and full jitter, honouring Retry-After
+- invalid responses (JSON that does not parse or match the schema) are
+  requested again right away, the provider itself is fine
+- anything else (bad request, auth) is raised on the first attempt
+- when a request is still running after the p95 latency of its recent
+  successes, a duplicate is started and the first result wins
+- each provider has a circuit breaker that opens after consecutive
+  transient failures, so a degraded provider is not hammered with more
+  requests; calls fail fast with CircuitOpenError until it half-opens
+"""
+
+import functools
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from dotenv import load_dotenv
+
+import metrics
+from json_extract import JSONExtractionError, SchemaError
+
+# Load environment variables
+load_dotenv()
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "20"))
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "1") == "1"
+# Successful calls needed before the p95 is trusted for hedging
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", "16"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
+# Error classes
+TRANSIENT = "transient"
+INVALID = "invalid"
+FATAL = "fatal"
+
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+# Client library exceptions for network failures (openai, httpx, requests),
+# matched by name so the libraries do not have to be imported here
+_TRANSPORT_ERRORS = {"APIConnectionError", "APITimeoutError", "TransportError", "TimeoutException",
+                     "ConnectionError", "Timeout"}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit breaker is open."""
+
+    def __init__(self, provider, retry_in):
+        super().__init__(f"Circuit for {provider} is open, retry in {retry_in:.0f}s")
+        self.provider = provider
+        self.retry_in = retry_in
+
+
+def status_code(exc):
+    """Returns the HTTP status of a client library exception, or None."""
+    code = getattr(exc, "status_code", None)
+    if code is None:
+        response = getattr(exc, "response", None)
+        code = getattr(response, "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def classify(exc):
+    """Returns TRANSIENT, INVALID or FATAL for an exception raised by a provider call."""
+    if isinstance(exc, (JSONExtractionError, SchemaError)):
+        return INVALID
+    code = status_code(exc)
+    if code is not None:
+        return TRANSIENT if code in RETRYABLE_STATUS else FATAL
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return TRANSIENT
+    if any(cls.__name__ in _TRANSPORT_ERRORS for cls in type(exc).__mro__):
+        return TRANSIENT
+    return FATAL
+
+
+def retry_after(exc):
+    """Seconds from a Retry-After header on the exception's response, or None."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=None, cap=None):
+    """Full-jitter exponential backoff for the given 1-based attempt."""
+    base = RETRY_BASE_DELAY if base is None else base
+    cap = RETRY_MAX_DELAY if cap is None else cap
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class LatencyStats:
+    """Latency and outcome counts of the most recent calls."""
+
+    def __init__(self, window=200):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.hedges = 0
+
+    def record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            self.successes += 1
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+    def percentile(self, q, min_samples=1):
+        """Latency at quantile q (0-1), or None with fewer than min_samples calls."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < max(min_samples, 1):
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    @property
+    def success_rate(self):
+        total = self.successes + self.failures
+        return self.successes / total if total else None
+
+    def stats(self):
+        return {
+            "successes": self.successes,
+            "failures": self.failures,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "success_rate": self.success_rate,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+        }
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker for one provider.
+
+    After failure_threshold transient failures in a row the circuit opens
+    and calls are refused for reset_timeout seconds. Then a single trial
+    call is let through (half-open): success closes the circuit, failure
+    opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=None, reset_timeout=None):
+        self.name = name
+        self.failure_threshold = failure_threshold or BREAKER_FAILURE_THRESHOLD
+        self.reset_timeout = reset_timeout or BREAKER_RESET_TIMEOUT
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raises CircuitOpenError if the call may not go ahead."""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            elapsed = time.monotonic() - self.opened_at
+            if self.state == OPEN and elapsed >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._trial_running = False
+            if self.state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            raise CircuitOpenError(self.name, max(0.0, self.reset_timeout - elapsed))
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def record_other(self):
+        """For a call that says nothing about the provider's health, e.g. a bad request."""
+        with self._lock:
+            # A half-open circuit lets the next call be the trial instead
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    print(f"Circuit for {self.name} opened after {self.failures} failures")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self._trial_running = False
+
+    def stats(self):
+        return {"state": self.state, "consecutive_failures": self.failures}
+
+
+_breakers = {}
+_stats = {}
+_executor = None
+# Hedge executor tasks submitted and not done yet
+_hedge_busy = 0
+_lock = threading.Lock()
+
+
+def get_breaker(provider):
+    with _lock:
+        breaker = _breakers.get(provider)
+        if breaker is None:
+            breaker = _breakers[provider] = CircuitBreaker(provider)
+        return breaker
+
+
+def get_stats(name):
+    """LatencyStats of a provider ("ai21") or of one operation ("ai21.maestro")."""
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = LatencyStats()
+        return stats
+
+
+def _hedge_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+        return _executor
+
+
+def _hedge_done(_):
+    global _hedge_busy
+    with _lock:
+        _hedge_busy -= 1
+
+
+def _hedge_submit(fn, *args):
+    """Runs fn(*args) on the hedge executor, returns None instead of queueing it."""
+    global _hedge_busy
+    executor = _hedge_executor()
+    with _lock:
+        if _hedge_busy >= HEDGE_WORKERS:
+            return None
+        _hedge_busy += 1
+    future = metrics.submit(executor, fn, *args)
+    future.add_done_callback(_hedge_done)
+    return future
+
+
+class Policy:
+    """
+    Resilience policy for one kind of provider request
+
+    Args:
+        provider (str): Provider name, shares the circuit breaker and stats
+        name (str): Operation name for per-operation latency (default: provider)
+        attempts (int): Maximum attempts (default: RETRY_MAX_ATTEMPTS)
+        hedge (bool): Start a duplicate request past the p95 latency
+            (default: HEDGE_REQUESTS); only for requests that are safe to repeat
+    """
+
+    def __init__(self, provider, name=None, attempts=None, hedge=None):
+        self.provider = provider
+        self.name = name or provider
+        self.attempts = attempts or RETRY_MAX_ATTEMPTS
+        self.hedge = HEDGE_REQUESTS if hedge is None else hedge
+        self.breaker = get_breaker(provider)
+        self.stats = get_stats(self.name)
+        self.provider_stats = get_stats(provider) if self.name != provider else None
+
+    def call(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) under the policy."""
+        attempt = 0
+        while True:
+            attempt += 1
+            self.breaker.before_call()
+            try:
+                result = self._attempt(fn, args, kwargs)
+            except Exception as e:
+                kind = classify(e)
+                if kind == TRANSIENT:
+                    self.breaker.record_failure()
+                else:
+                    # A rejected or unusable request neither opens nor closes
+                    # the circuit
+                    self.breaker.record_other()
+                self._record_failure()
+                if kind == FATAL or attempt >= self.attempts:
+                    raise
+                self.stats.retries += 1
+                metrics.record_retry(self.name)
+                if kind == TRANSIENT:
+                    delay = retry_after(e)
+                    delay = min(delay, RETRY_MAX_DELAY) if delay is not None else backoff_delay(attempt)
+                    print(f"{self.name} attempt {attempt} failed ({e}), retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                else:
+                    print(f"{self.name} attempt {attempt} returned an invalid response ({e}), retrying")
+                continue
+            self.breaker.record_success()
+            return result
+
+    def _record_failure(self):
+        self.stats.record_failure()
+        if self.provider_stats is not None:
+            self.provider_stats.record_failure()
+
+    def _timed(self, fn, args, kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        self.stats.record(elapsed)
+        if self.provider_stats is not None:
+            self.provider_stats.record(elapsed)
+        return result
+
+    def _attempt(self, fn, args, kwargs):
+        hedge_after = self.stats.percentile(0.95, HEDGE_MIN_SAMPLES) if self.hedge else None
+        if hedge_after is None:
+            return self._timed(fn, args, kwargs)
+
+        first = _hedge_submit(self._timed, fn, args, kwargs)
+        if first is None:
+            # Every hedge worker is busy. Queued, the request would sit out
+            # its hedge timeout before it even started, so it is sent from
+            # this thread without a hedge
+            return self._timed(fn, args, kwargs)
+        try:
+            return first.result(timeout=hedge_after)
+        except FutureTimeout:
+            pass
+
+        # The first request is slower than 95% of recent ones, race a duplicate.
+        # The loser cannot be cancelled mid-request, its result is dropped
+        duplicate = _hedge_submit(self._timed, fn, args, kwargs)
+        if duplicate is None:
+            return first.result()
+        self.stats.hedges += 1
+        metrics.record_hedge(self.name)
+        pending = {first, duplicate}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+        raise error
+
+
+def resilient(provider, name=None, attempts=None, hedge=None):
+    """Decorator applying a Policy to every call of a function."""
+    policy = Policy(provider, name=name, attempts=attempts, hedge=hedge)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return policy.call(fn, *args, **kwargs)
+
+        wrapper.policy = policy
+        return wrapper
+
+    return decorator
+
+
+def stats():
+    """Circuit state and latency stats of every provider and operation."""
+    with _lock:
+        breakers = dict(_breakers)
+        latencies = dict(_stats)
+    return {
+        "circuits": {name: breaker.stats() for name, breaker in breakers.items()},
+        "latency": {name: value.stats() for name, value in latencies.items()},
+    }
@@ -0,0 +1,278 @@
+"""
+Battle generation router.
+
+The same battle JSON can come from three routes:
+
+    maestro   AI21 Maestro with web search (web_search_maestro.query_maestro)
+    chatgpt   gpt-4-turbo (web_search.query_chatgpt)
+    jamba     the AI21 jamba-large chat model
+
+Routes are ranked by their recent end-to-end latency and success rate. In
+"race" mode the best ROUTER_RACE_WIDTH routes run at the same time and the
+first schema-valid battle wins; in "fallback" mode they are tried one after
+another. Either way the remaining routes are tried if every raced one
+fails. Routes whose provider has no API key or an open circuit are skipped.
+
+A losing route can't be stopped mid-request, so it keeps its thread and
+provider slot until it finishes. At most ROUTER_MAX_LOSERS of them may run
+at once; past that, generate() stops racing and runs only the best route.
+Each raced route records its spans in a trace of its own, and only the
+winner's and the failed routes' spans end up in the job's trace.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from dotenv import load_dotenv
+
+import metrics
+import providers
+import resilience
+from json_extract import extract_battle
+
+# Load environment variables
+load_dotenv()
+
+ROUTER_MODE = os.getenv("ROUTER_MODE", "race")
+# Routes in order of preference while there are no stats yet
+ROUTER_ROUTES = [name.strip() for name in os.getenv("ROUTER_ROUTES", "maestro,chatgpt,jamba").split(",") if name.strip()]
+ROUTER_RACE_WIDTH = int(os.getenv("ROUTER_RACE_WIDTH", "2"))
+# Losing routes still running in the background before racing is paused
+ROUTER_MAX_LOSERS = int(os.getenv("ROUTER_MAX_LOSERS", "2"))
+# Floor for the success rate when ranking, so one failure does not bury a route
+ROUTER_MIN_SUCCESS_RATE = 0.05
+
+JAMBA_SYSTEM_PROMPT = ("You create battle simulations between two characters. "
+                       "Reply with the JSON object only.")
+
+
+def _maestro(topic):
+    # Imported here because web_search_maestro imports this module
+    from web_search_maestro import create_battle_query, query_maestro
+
+    with metrics.span("query_build"):
+        query = create_battle_query(topic)
+    return query_maestro(query)
+
+
+@resilience.resilient("openai", name="openai.battle")
+def _chatgpt_battle(query):
+    from web_search import query_chatgpt
+
+    # The request without its own policy, so an unusable answer is asked
+    # again here and transient errors are not retried twice over
+    with metrics.span("chatgpt_run"):
+        response = query_chatgpt.__wrapped__(query)
+    content = response["choices"][0]["message"]["content"]
+    with metrics.span("json_parse") as span:
+        span.set_size(len(content))
+        return extract_battle(content)
+
+
+def _chatgpt(topic):
+    from web_search import create_battle_query
+
+    with metrics.span("query_build"):
+        query = create_battle_query(topic)
+    return _chatgpt_battle(query)
+
+
+@resilience.resilient("ai21", name="ai21.battle", attempts=2)
+def _jamba(topic):
+    from gen_chat_prompt import chat
+    from web_search import create_battle_query
+
+    with metrics.span("query_build"):
+        query = create_battle_query(topic)
+    with metrics.span("jamba_run"):
+        out = chat([{"role": "system", "content": JAMBA_SYSTEM_PROMPT},
+                    {"role": "user", "content": query}])
+    with metrics.span("json_parse") as span:
+        span.set_size(len(out))
+        return extract_battle(out)
+
+
+# route -> (provider, generate(topic) -> validated battle)
+ROUTES = {
+    "maestro": ("ai21", _maestro),
+    "chatgpt": ("openai", _chatgpt),
+    "jamba": ("ai21", _jamba),
+}
+
+
+class NoRouteError(RuntimeError):
+    """Raised when no route is available or every route failed."""
+
+
+class Router:
+    """
+    Picks and runs battle generation routes
+
+    Args:
+        routes (list): Route names in order of preference (default: ROUTER_ROUTES)
+        mode (str): "race" or "fallback" (default: ROUTER_MODE)
+        race_width (int): Routes raced at once (default: ROUTER_RACE_WIDTH)
+        max_losers (int): Losing routes left running before racing pauses
+            (default: ROUTER_MAX_LOSERS)
+    """
+
+    def __init__(self, routes=None, mode=None, race_width=None, max_losers=None):
+        self.routes = routes or ROUTER_ROUTES
+        unknown = [name for name in self.routes if name not in ROUTES]
+        if unknown:
+            raise ValueError(f"Unknown routes: {', '.join(unknown)}")
+        self.mode = mode or ROUTER_MODE
+        self.race_width = race_width or ROUTER_RACE_WIDTH
+        self.max_losers = ROUTER_MAX_LOSERS if max_losers is None else max_losers
+        # Losing routes still running
+        self.losers = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def stats_for(route):
+        return resilience.get_stats(f"route.{route}")
+
+    def available(self, route):
+        provider = ROUTES[route][0]
+        if not os.getenv(providers.PROVIDERS[provider]["api_key_env"]):
+            return False
+        return resilience.get_breaker(provider).state != resilience.OPEN or self._breaker_expired(provider)
+
+    @staticmethod
+    def _breaker_expired(provider):
+        breaker = resilience.get_breaker(provider)
+        return time.monotonic() - breaker.opened_at >= breaker.reset_timeout
+
+    def expected_latency(self, route):
+        """Median latency divided by success rate, None before the route has run."""
+        stats = self.stats_for(route)
+        if not stats.successes and not stats.failures:
+            return None
+        p50 = stats.percentile(0.5)
+        if p50 is None:
+            # Every call so far failed
+            return float("inf")
+        return p50 / max(stats.success_rate or 0, ROUTER_MIN_SUCCESS_RATE)
+
+    def ranked(self):
+        """Available routes, untried ones first in preference order, then fastest first."""
+        routes = [route for route in self.routes if self.available(route)]
+        untried = [route for route in routes if self.expected_latency(route) is None]
+        tried = sorted((route for route in routes if route not in untried), key=self.expected_latency)
+        return untried + tried
+
+    def _run(self, route, topic):
+        stats = self.stats_for(route)
+        start = time.perf_counter()
+        try:
+            with metrics.span("generate", route=route):
+                battle = ROUTES[route][1](topic)
+        except Exception:
+            stats.record_failure()
+            raise
+        stats.record(time.perf_counter() - start)
+        return battle
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(len(ROUTES), self.race_width) * 2,
+                                                    thread_name_prefix="router")
+            return self._executor
+
+    def _loser_done(self, _):
+        with self._lock:
+            self.losers -= 1
+
+    def _race(self, routes, topic, errors):
+        parent = metrics.current_trace()
+        futures = {}
+        for route in routes:
+            future, trace = metrics.submit_detached(self._pool(), self._run, route, topic)
+            futures[future] = (route, trace)
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                route, trace = futures[future]
+                if parent is not None:
+                    parent.merge(trace)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors[route] = e
+                    continue
+                # Losing routes keep running in the background, their
+                # results only update the stats and their spans are dropped
+                for loser in pending:
+                    if not loser.cancel():
+                        with self._lock:
+                            self.losers += 1
+                        loser.add_done_callback(self._loser_done)
+                return route, result
+        return None
+
+    def race_width_now(self):
+        """Routes to race right now, 1 while too many losers are still running."""
+        with self._lock:
+            return 1 if self.losers >= self.max_losers else self.race_width
+
+    def generate(self, topic):
+        """
+        Generates a battle for a topic
+
+        Returns:
+            tuple: (route, battle)
+
+        Raises:
+            NoRouteError: If no route is available or all of them failed
+        """
+        routes = self.ranked()
+        if not routes:
+            raise NoRouteError("No battle generation route is available")
+
+        errors = {}
+        width = self.race_width_now() if self.mode == "race" else 1
+        if width > 1:
+            first, routes = routes[:width], routes[width:]
+            result = self._race(first, topic, errors)
+            if result is not None:
+                return result
+
+        for route in routes:
+            try:
+                return route, self._run(route, topic)
+            except Exception as e:
+                print(f"Route {route} failed: {e}")
+                errors[route] = e
+
+        raise NoRouteError("; ".join(f"{route}: {e}" for route, e in errors.items()))
+
+    def stats(self):
+        routes = {}
+        for route in self.routes:
+            expected = self.expected_latency(route)
+            routes[route] = {**self.stats_for(route).stats(), "available": self.available(route),
+                             # Infinity is not valid JSON
+                             "expected_latency": expected if expected != float("inf") else None}
+        return {"mode": self.mode, "ranked": self.ranked(), "losers": self.losers, "routes": routes}
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = Router()
+        return _router
+
+
+def generate(topic):
+    """Generates a battle with the shared router, returns (route, battle)."""
+    return get_router().generate(topic)
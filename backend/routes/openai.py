@@ -4,46 +4,52 @@ import requests  # used to download images
 import os  # used to access filepaths
 from PIL import Image  # used to print and edit images
 
-# initialize OpenAI client
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY", "<your OpenAI API key if not set as env var>"))
 
-# set a directory to save DALL·E images to
-image_dir_name = "images"
-image_dir = os.path.join(os.curdir, image_dir_name)
+def main():
+    # initialize OpenAI client
+    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY", "<your OpenAI API key if not set as env var>"))
 
-# create the directory if it doesn't yet exist
-if not os.path.isdir(image_dir):
-    os.mkdir(image_dir)
+    # set a directory to save DALL·E images to
+    image_dir_name = "images"
+    image_dir = os.path.join(os.curdir, image_dir_name)
 
-# print the directory to save to
-print(f"{image_dir=}")
+    # create the directory if it doesn't yet exist
+    if not os.path.isdir(image_dir):
+        os.mkdir(image_dir)
 
-# create an image
+    # print the directory to save to
+    print(f"{image_dir=}")
 
-# set the prompt
-prompt = "A cyberpunk monkey hacker dreaming of a beautiful bunch of bananas, digital art"
+    # create an image
 
-# call the OpenAI API
-generation_response = client.images.generate(
-    model = "dall-e-3",
-    prompt=prompt,
-    n=1,
-    size="1024x1024",
-    response_format="url",
-)
+    # set the prompt
+    prompt = "A cyberpunk monkey hacker dreaming of a beautiful bunch of bananas, digital art"
 
-# print response
-print(generation_response)
+    # call the OpenAI API
+    generation_response = client.images.generate(
+        model = "dall-e-3",
+        prompt=prompt,
+        n=1,
+        size="1024x1024",
+        response_format="url",
+    )
 
-# save the image
-generated_image_name = "generated_image.png"  # any name you like; the filetype should be .png
-generated_image_filepath = os.path.join(image_dir, generated_image_name)
-generated_image_url = generation_response.data[0].url  # extract image URL from response
-generated_image = requests.get(generated_image_url).content  # download the image
+    # print response
+    print(generation_response)
 
-with open(generated_image_filepath, "wb") as image_file:
-    image_file.write(generated_image)  # write the image to the file
+    # save the image
+    generated_image_name = "generated_image.png"  # any name you like; the filetype should be .png
+    generated_image_filepath = os.path.join(image_dir, generated_image_name)
+    generated_image_url = generation_response.data[0].url  # extract image URL from response
+    generated_image = requests.get(generated_image_url).content  # download the image
 
-    # print the image
-print(generated_image_filepath)
-display(Image.open(generated_image_filepath))
+    with open(generated_image_filepath, "wb") as image_file:
+        image_file.write(generated_image)  # write the image to the file
+
+        # print the image
+    print(generated_image_filepath)
+    Image.open(generated_image_filepath).show()
+
+
+if __name__ == "__main__":
+    main()
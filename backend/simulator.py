@@ -0,0 +1,193 @@
+"""
+Vectorized Monte-Carlo balance simulator for generated battles.
+
+Plays many random-move battles between Character_1 and Character_2 of a
+battle JSON at once, with NumPy arrays holding the HP and damage of every
+battle. Checking a generated battle takes a few milliseconds, so generation
+can reject or rebalance lopsided matchups.
+
+The simulation uses the same miss chance and effectiveness distribution as
+battle_engine, but ignores status effects.
+"""
+
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+
+from battle_engine import BASE_MISS_CHANCE, EFFECTIVENESS_MEAN, EFFECTIVENESS_SPREAD, to_int
+
+# Load environment variables
+load_dotenv()
+
+DEFAULT_HP = int(os.getenv("BATTLE_DEFAULT_HP", "300"))
+BALANCE_SIMULATIONS = int(os.getenv("BALANCE_SIMULATIONS", "20000"))
+# A battle is lopsided when either side wins more often than this
+BALANCE_MAX_WIN_RATE = float(os.getenv("BALANCE_MAX_WIN_RATE", "0.7"))
+# "rebalance" fixes lopsided battles, "report" only measures them, "off" skips the check
+BALANCE_MODE = os.getenv("BALANCE_MODE", "rebalance")
+
+CHARACTER_KEYS = ("Character_1", "Character_2")
+
+
+def battle_arrays(battle, default_hp=None):
+    """
+    Extracts HP and move damage from a battle JSON
+
+    Returns:
+        tuple: (hp, damage) with shapes (2,) and (2, 4)
+    """
+    default_hp = default_hp or DEFAULT_HP
+    hp = np.empty(2, dtype=np.float64)
+    damage = np.empty((2, 4), dtype=np.float64)
+    for i, key in enumerate(CHARACTER_KEYS):
+        character = battle[key]
+        hp[i] = to_int(character.get("HP"), default_hp) or default_hp
+        for j in range(4):
+            damage[i, j] = to_int(character["Moves"][f"Move_{j + 1}"].get("Damage"))
+    return hp, damage
+
+
+def _effectiveness(rng, size):
+    effectiveness = np.clip(np.rint(rng.normal(EFFECTIVENESS_MEAN, EFFECTIVENESS_SPREAD, size)), 0, 200)
+    effectiveness[rng.random(size) < BASE_MISS_CHANCE] = 0
+    return effectiveness
+
+
+def simulate(battle, n=None, max_rounds=100, seed=None, default_hp=None):
+    """
+    Plays n random-move battles at once
+
+    Args:
+        battle (dict): Battle JSON with Character_1 and Character_2
+        n (int): Number of battles (default: BALANCE_SIMULATIONS)
+        max_rounds (int): Rounds after which an unfinished battle is a tie
+        seed (int): Seed for NumPy's generator
+        default_hp (int): HP for characters without one (default: DEFAULT_HP)
+
+    Returns:
+        dict: Win and tie rates, rounds to KO and per-hit damage statistics
+    """
+    n = n or BALANCE_SIMULATIONS
+    hp, damage = battle_arrays(battle, default_hp)
+    rng = np.random.default_rng(seed)
+
+    hp_1 = np.full(n, hp[0])
+    hp_2 = np.full(n, hp[1])
+    rounds = np.zeros(n, dtype=np.int32)
+    active = np.arange(n)
+    hit_sum = np.zeros(2)
+    hit_sq_sum = np.zeros(2)
+    hits = 0
+
+    for _ in range(max_rounds):
+        if active.size == 0:
+            break
+        size = active.size
+        dealt_1 = damage[0, rng.integers(0, 4, size)] * _effectiveness(rng, size) / 100
+        dealt_2 = damage[1, rng.integers(0, 4, size)] * _effectiveness(rng, size) / 100
+
+        hp_2[active] -= dealt_1
+        hp_1[active] -= dealt_2
+        rounds[active] += 1
+
+        hit_sum += dealt_1.sum(), dealt_2.sum()
+        hit_sq_sum += np.square(dealt_1).sum(), np.square(dealt_2).sum()
+        hits += size
+
+        active = active[(hp_1[active] > 0) & (hp_2[active] > 0)]
+
+    wins_1 = np.count_nonzero((hp_1 > 0) & (hp_2 <= 0))
+    wins_2 = np.count_nonzero((hp_2 > 0) & (hp_1 <= 0))
+    mean_hit = hit_sum / max(hits, 1)
+    hit_variance = hit_sq_sum / max(hits, 1) - np.square(mean_hit)
+
+    report = {
+        "simulations": n,
+        "win_rate_1": float(wins_1 / n),
+        "win_rate_2": float(wins_2 / n),
+        "tie_rate": float((n - wins_1 - wins_2) / n),
+        "mean_rounds": float(rounds.mean()),
+        "unfinished": int(active.size),
+        "mean_damage_1": float(mean_hit[0]),
+        "mean_damage_2": float(mean_hit[1]),
+        "damage_variance_1": float(hit_variance[0]),
+        "damage_variance_2": float(hit_variance[1]),
+    }
+    report["balanced"] = is_balanced(report)
+    return report
+
+
+def is_balanced(report, max_win_rate=None):
+    max_win_rate = max_win_rate or BALANCE_MAX_WIN_RATE
+    return bool(max(report["win_rate_1"], report["win_rate_2"]) <= max_win_rate)
+
+
+def rebalance(battle, default_hp=None):
+    """
+    Scales the stronger character's move damage so both sides need about
+    the same number of rounds to knock the other out
+
+    Returns:
+        dict: A rebalanced copy of the battle
+    """
+    hp, damage = battle_arrays(battle, default_hp)
+    mean_damage = damage.mean(axis=1)
+    if not mean_damage.all():
+        return battle
+
+    # Rounds each side needs to KO the other with average hits
+    rounds_to_ko = hp[::-1] / mean_damage
+    stronger = int(np.argmin(rounds_to_ko))
+    factor = rounds_to_ko[stronger] / rounds_to_ko[1 - stronger]
+
+    rebalanced = {**battle}
+    key = CHARACTER_KEYS[stronger]
+    character = {**battle[key], "Moves": {name: dict(move) for name, move in battle[key]["Moves"].items()}}
+    for j in range(4):
+        move = character["Moves"][f"Move_{j + 1}"]
+        value = max(1, int(round(damage[stronger, j] * factor)))
+        # Keep the value's type, generators return both "40" and 40
+        move["Damage"] = str(value) if isinstance(move.get("Damage"), str) else value
+    rebalanced[key] = character
+    return rebalanced
+
+
+def check_and_rebalance(battle, n=None, seed=None):
+    """
+    Simulates a battle and rebalances it if it is lopsided
+
+    Returns:
+        tuple: (battle, report) where report describes the returned battle and
+        has a "rebalanced" flag
+    """
+    report = simulate(battle, n=n, seed=seed)
+    if report["balanced"]:
+        report["rebalanced"] = False
+        return battle, report
+
+    balanced_battle = rebalance(battle)
+    new_report = simulate(balanced_battle, n=n, seed=seed)
+    new_report["rebalanced"] = True
+    new_report["original"] = report
+    return balanced_battle, new_report
+
+
+def balance_battle(battle, mode=None):
+    """
+    Applies BALANCE_MODE to a freshly generated battle
+
+    Returns:
+        tuple: (battle, report), report is None when the check was skipped or
+        the battle could not be simulated
+    """
+    mode = mode or BALANCE_MODE
+    if mode == "off":
+        return battle, None
+    try:
+        if mode == "rebalance":
+            return check_and_rebalance(battle)
+        return battle, simulate(battle)
+    except (KeyError, TypeError, AttributeError) as e:
+        print(f"Could not simulate battle: {e}")
+        return battle, None
@@ -0,0 +1,217 @@
+"""
+Speculative pre-generation of llm battle rounds.
+
+A round's provider request can only start once both players have chosen,
+so every turn they wait for the whole completion. There are only 4 x 4
+possible move pairs, though. While the players are still choosing, a
+Speculator already requests the likeliest pairs in the background. If the
+pair the players pick was among them, its round is served as soon as
+the request finishes, often immediately. The other requests are cancelled,
+or their results are discarded if they already started.
+
+Which pairs are likeliest comes from MovePredictor: every move starts with
+a weight proportional to its damage, and each player's earlier picks in the
+battle are added on top. Speculation is bounded per round by
+SPECULATION_WIDTH requests and per battle by SPECULATION_TOKEN_BUDGET
+estimated tokens spent on requests that went unused. Once the budget is
+used up, rounds are requested on demand again.
+"""
+
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from battle_session import estimate_tokens
+import metrics
+
+# Load environment variables
+load_dotenv()
+
+# Move pairs requested ahead per round
+SPECULATION_WIDTH = int(os.getenv("SPECULATION_WIDTH", "3"))
+# Estimated tokens a battle may spend on speculative requests that go unused
+SPECULATION_TOKEN_BUDGET = int(os.getenv("SPECULATION_TOKEN_BUDGET", "20000"))
+# Threads running speculative requests, shared by all battles
+SPECULATION_WORKERS = int(os.getenv("SPECULATION_WORKERS", "16"))
+# Expected completion size of a round, added to the prompt estimate
+ROUND_COMPLETION_TOKENS = 350
+# Weight of the damage-based prior against the player's own picks
+PRIOR_WEIGHT = 2.0
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=SPECULATION_WORKERS, thread_name_prefix="speculate")
+    return _executor
+
+
+class MovePredictor:
+    """
+    Probability of each of a player's moves being picked next.
+
+    Args:
+        player (dict): gen_chat_prompt player dict
+        prior_weight (float): How many picks the damage prior is worth
+    """
+
+    def __init__(self, player, prior_weight=PRIOR_WEIGHT):
+        keys = ("move_1", "move_2", "move_3", "move_4")
+        damage = {key: max(float(player[key]["dmg"]), 1.0) for key in keys}
+        total = sum(damage.values())
+        self.prior = {key: value / total for key, value in damage.items()}
+        self.prior_weight = prior_weight
+        self.counts = dict.fromkeys(keys, 0)
+
+    def observe(self, move):
+        if move in self.counts:
+            self.counts[move] += 1
+
+    def probabilities(self):
+        picks = sum(self.counts.values())
+        return {key: (self.counts[key] + self.prior_weight * self.prior[key]) / (picks + self.prior_weight)
+                for key in self.counts}
+
+
+def likeliest_pairs(predictor_1, predictor_2, n=None):
+    """The n likeliest (move_1, move_2) pairs with their probabilities, likeliest first."""
+    probabilities_1 = predictor_1.probabilities()
+    probabilities_2 = predictor_2.probabilities()
+    pairs = sorted(((p1 * p2, (move_1, move_2))
+                    for move_1, p1 in probabilities_1.items()
+                    for move_2, p2 in probabilities_2.items()), reverse=True)
+    return [(pair, probability) for probability, pair in pairs[:n]]
+
+
+class Speculator:
+    """
+    Speculative rounds of one llm battle.
+
+    Call start() when the players start choosing and play() with their
+    choice. play() starts the speculation of the next round by itself.
+
+    Args:
+        battle (gen_chat_prompt.Battle): A battle with the llm engine
+        width (int): Pairs requested ahead per round (default: SPECULATION_WIDTH)
+        token_budget (int): Unused speculative tokens allowed (default:
+            SPECULATION_TOKEN_BUDGET)
+
+    Raises:
+        ValueError: For local engine battles, whose rounds can't be resolved
+            without changing the battle
+    """
+
+    def __init__(self, battle, width=None, token_budget=None):
+        if battle.engine != "llm":
+            raise ValueError("Only llm engine rounds can be resolved speculatively")
+        self.battle = battle
+        self.width = SPECULATION_WIDTH if width is None else width
+        self.token_budget = SPECULATION_TOKEN_BUDGET if token_budget is None else token_budget
+        self.predictors = (MovePredictor(battle.p1), MovePredictor(battle.p2))
+        # (move_1, move_2) -> (future, estimated tokens)
+        self._pending = {}
+        self.wasted_tokens = 0
+        self.counts = {"hit": 0, "miss": 0, "cancelled": 0, "wasted": 0}
+
+    def start(self):
+        """
+        Requests the likeliest pairs of the next round in the background
+
+        Returns:
+            list: The pairs being requested
+        """
+        self.cancel()
+        if not self.battle.both_alive:
+            return []
+        for pair, _ in likeliest_pairs(*self.predictors, self.width):
+            messages = self.battle.messages(*pair)
+            cost = sum(estimate_tokens(message["content"]) for message in messages) + ROUND_COMPLETION_TOKENS
+            # Worst case every request of this round goes unused
+            committed = sum(entry[1] for entry in self._pending.values())
+            if self.wasted_tokens + committed + cost > self.token_budget:
+                break
+            future = metrics.submit(get_executor(), self.battle.resolve, *pair, messages=messages)
+            self._pending[pair] = (future, cost)
+        return list(self._pending)
+
+    def cancel(self):
+        """Drops the speculative requests of the current round."""
+        for future, cost in self._pending.values():
+            if future.cancel():
+                outcome = "cancelled"
+            else:
+                # Already sent, so it is paid for
+                outcome = "wasted"
+                self.wasted_tokens += cost
+            self.counts[outcome] += 1
+            metrics.SPECULATIONS.inc(outcome=outcome)
+        self._pending.clear()
+
+    def play(self, move_1, move_2):
+        """
+        Plays the round the players chose, from a speculative request if there is one
+
+        Returns:
+            tuple: (round_json, raw_response)
+        """
+        self.predictors[0].observe(move_1)
+        self.predictors[1].observe(move_2)
+        entry = self._pending.pop((move_1, move_2), None)
+        self.cancel()
+
+        result = None
+        with metrics.span("battle_round", engine=self.battle.engine, speculative=entry is not None):
+            if entry is not None:
+                try:
+                    result = entry[0].result()
+                except Exception as e:
+                    print(f"Speculative round failed, requesting it again: {e}")
+            outcome = "hit" if result is not None else "miss"
+            self.counts[outcome] += 1
+            metrics.SPECULATIONS.inc(outcome=outcome)
+            if result is None:
+                result = self.battle.resolve(move_1, move_2)
+
+        round_json, out, usage = result
+        self.battle.apply(move_1, move_2, round_json, usage)
+        self.start()
+        return round_json, out
+
+    def stats(self):
+        return {**self.counts, "wasted_tokens": self.wasted_tokens, "token_budget": self.token_budget}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play an example llm battle with speculative rounds")
+    parser.add_argument("--think", type=float, default=2.0, help="Seconds the players take to choose")
+    parser.add_argument("--width", type=int, default=None, help="Pairs requested ahead per round")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    from gen_chat_prompt import Battle, p1, p2
+
+    battle = Battle(p1, p2, engine="llm", seed=args.seed)
+    speculator = Speculator(battle, width=args.width)
+    speculator.start()
+    while battle.both_alive:
+        time.sleep(args.think)
+        move_1, move_2 = battle.choose_moves()
+        start = time.perf_counter()
+        speculator.play(move_1, move_2)
+        print(f"Round {battle.round_number} ({move_1}, {move_2}) served in {time.perf_counter() - start:.2f}s")
+    speculator.cancel()
+    print(f"Winner: {battle.winner or 'tie'}")
+    print(f"Speculation: {speculator.stats()}")
+
+
+if __name__ == "__main__":
+    main()
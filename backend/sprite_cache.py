@@ -0,0 +1,205 @@
+"""
+Content-addressed on-disk cache for generated sprites and backgrounds.
+
+Entries are keyed by a hash of the normalized prompt text, the image model
+and the style instructions, so the same character asked for again skips
+both the image generation call and background removal. The cache is bounded
+by total size and evicts the least recently used entries first.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from dotenv import load_dotenv
+from artifacts import atomic_save_image
+
+# Load environment variables
+load_dotenv()
+
+SPRITE_CACHE_ENABLED = os.getenv("SPRITE_CACHE", "1") == "1"
+SPRITE_CACHE_DIR = os.getenv("SPRITE_CACHE_DIR", "./.cache/sprites")
+SPRITE_CACHE_MAX_MB = int(os.getenv("SPRITE_CACHE_MAX_MB", "500"))
+
+RAW = "raw"
+NO_BG = "no_bg"
+
+
+def normalize_text(text):
+    """Lower-cases text and collapses whitespace so trivial edits share a key."""
+    return " ".join(str(text).lower().split())
+
+
+def sprite_key(kind, text, model, style):
+    """
+    Builds the cache key for one image
+
+    Args:
+        kind (str): "character" or "background"
+        text (str): The subject text of the prompt
+        model (str): Image model name
+        style (str): Style instructions appended to the prompt
+
+    Returns:
+        str: Hex sha256 digest
+    """
+    payload = json.dumps({
+        "kind": kind,
+        "text": normalize_text(text),
+        "model": model,
+        "style": normalize_text(style),
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SpriteCache:
+    """
+    Stores the raw and background-removed PNG of each key on disk.
+
+    Last access time is tracked through file mtimes, so the LRU order is
+    shared by every process using the same directory. The total size is
+    counted from one directory scan and then kept up to date by put(); the
+    cache is only scanned again when that count goes over max_bytes, and
+    eviction removes every variant of an entry together.
+
+    Args:
+        directory (str): Cache directory (default: SPRITE_CACHE_DIR)
+        max_bytes (int): Total size above which entries are evicted
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or SPRITE_CACHE_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else SPRITE_CACHE_MAX_MB * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Total bytes on disk, None until the first scan
+        self._size = None
+        self._lock = threading.Lock()
+
+    def path(self, key, variant=RAW):
+        suffix = "" if variant == RAW else f"_{variant}"
+        return os.path.join(self.directory, key[:2], f"{key}{suffix}.png")
+
+    def get(self, key, variants=(RAW,)):
+        """
+        Looks up an entry
+
+        Args:
+            key (str): Key from sprite_key()
+            variants (tuple): Variants that must all be present for a hit
+
+        Returns:
+            dict: Path per variant, or None on a miss
+        """
+        paths = {variant: self.path(key, variant) for variant in variants}
+        if not all(os.path.exists(p) for p in paths.values()):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        for p in paths.values():
+            try:
+                os.utime(p)
+            except OSError:
+                pass
+        with self._lock:
+            self.hits += 1
+        return paths
+
+    def put(self, key, image, variant=RAW):
+        """Saves a PIL image under key, replacing any previous copy atomically."""
+        target = self.path(key, variant)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            replaced = os.path.getsize(target)
+        except OSError:
+            replaced = 0
+        atomic_save_image(image, target)
+        size = os.path.getsize(target)
+        with self._lock:
+            if self._size is None:
+                # Other processes sharing the directory are only seen by a scan
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += size - replaced
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+        return target
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".png"):
+                    continue
+                p = os.path.join(root, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+        return entries
+
+    def evict(self):
+        """Deletes least recently used entries until the cache fits in max_bytes."""
+        # key -> [last access, files], over all variants of the key
+        grouped = {}
+        total = 0
+        for mtime, size, p in self._entries():
+            entry = grouped.setdefault(os.path.basename(p)[:64], [0.0, []])
+            entry[0] = max(entry[0], mtime)
+            entry[1].append((p, size))
+            total += size
+
+        removed = 0
+        for _, files in sorted(grouped.values()):
+            if total <= self.max_bytes:
+                break
+            for p, size in files:
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    continue
+                total -= size
+            removed += 1
+        with self._lock:
+            self._size = total
+            self.evictions += removed
+        return removed
+
+    def stats(self):
+        entries = self._entries()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "files": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Returns the process-wide SpriteCache, or None when SPRITE_CACHE=0."""
+    global _cache
+    if not SPRITE_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SpriteCache()
+    return _cache
@@ -0,0 +1,234 @@
+"""
+Streaming battle rounds.
+
+Runs the per-round battle prompt in the provider's streaming mode and parses
+the JSON answer as it arrives, so narrative_1 can be shown to the player
+while the model is still writing the rest of the round.
+"""
+
+import json
+
+from gen_chat_prompt import generate_battle_messages, upd_players_and_state
+from json_extract import validate_round
+import providers
+
+# Parser states
+_SEEK_OBJECT = "seek_object"
+_SEEK_KEY = "seek_key"
+_KEY = "key"
+_SEEK_COLON = "seek_colon"
+_SEEK_VALUE = "seek_value"
+_STRING = "string"
+_SCALAR = "scalar"
+_DONE = "done"
+
+# Marks the closing quote of a string value
+_END = object()
+
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class JsonFieldStream:
+    """
+    Incremental parser for the flat JSON object of a battle round.
+
+    Text is fed in arbitrary chunks. Anything before the first "{" (code
+    fences, chatter) is skipped. feed() returns the events the chunk
+    completed:
+
+        ("field_start", key)      a new top-level field began
+        ("delta", key, text)      more decoded text of a string field
+        ("field", key, value)     a field is complete
+        ("done", obj)             the closing brace was reached
+    """
+
+    def __init__(self):
+        self.state = _SEEK_OBJECT
+        self.fields = {}
+        self._key = None
+        self._buffer = []
+        self._escape = None
+        self._depth = 0
+        self._in_scalar_string = False
+
+    @property
+    def done(self):
+        return self.state == _DONE
+
+    def feed(self, text):
+        events = []
+        delta = []
+        for char in text:
+            if self.state == _STRING:
+                decoded = self._string_char(char)
+                if decoded is None:
+                    continue
+                if decoded is _END:
+                    if delta:
+                        events.append(("delta", self._key, "".join(delta)))
+                        delta = []
+                    self._finish_field("".join(self._buffer), events)
+                else:
+                    self._buffer.append(decoded)
+                    delta.append(decoded)
+            else:
+                self._structural_char(char, events)
+            if self.state == _DONE:
+                break
+        if delta:
+            events.append(("delta", self._key, "".join(delta)))
+        return events
+
+    def _string_char(self, char):
+        # Returns the decoded character, None for nothing yet, or _END
+        if self._escape is not None:
+            if self._escape == "":
+                if char == "u":
+                    self._escape = "u"
+                    return None
+                self._escape = None
+                return _ESCAPES.get(char, char)
+            self._escape += char
+            if len(self._escape) < 5:
+                return None
+            code = self._escape[1:]
+            self._escape = None
+            try:
+                return chr(int(code, 16))
+            except ValueError:
+                return ""
+        if char == "\\":
+            self._escape = ""
+            return None
+        if char == '"':
+            return _END
+        return char
+
+    def _structural_char(self, char, events):
+        state = self.state
+        if state == _SEEK_OBJECT:
+            if char == "{":
+                self.state = _SEEK_KEY
+        elif state == _SEEK_KEY:
+            if char == '"':
+                self.state = _KEY
+                self._buffer = []
+            elif char == "}":
+                self.state = _DONE
+                events.append(("done", self.fields))
+        elif state == _KEY:
+            if char == '"':
+                self._key = "".join(self._buffer)
+                self.state = _SEEK_COLON
+            else:
+                self._buffer.append(char)
+        elif state == _SEEK_COLON:
+            if char == ":":
+                self.state = _SEEK_VALUE
+                events.append(("field_start", self._key))
+        elif state == _SEEK_VALUE:
+            if char == '"':
+                self.state = _STRING
+                self._buffer = []
+            elif not char.isspace():
+                self.state = _SCALAR
+                self._buffer = [char]
+                self._depth = 1 if char in "[{" else 0
+                self._in_scalar_string = False
+        elif state == _SCALAR:
+            self._scalar_char(char, events)
+
+    def _scalar_char(self, char, events):
+        if self._in_scalar_string:
+            self._in_scalar_string = char != '"' or self._buffer[-1] == "\\"
+            self._buffer.append(char)
+            return
+        if self._depth == 0 and char in ",}":
+            raw = "".join(self._buffer).strip()
+            try:
+                value = json.loads(raw)
+            except ValueError:
+                value = raw
+            self._finish_field(value, events)
+            if char == "}":
+                self.state = _DONE
+                events.append(("done", self.fields))
+            return
+        if char == '"':
+            self._in_scalar_string = True
+        elif char in "[{":
+            self._depth += 1
+        elif char in "]}":
+            self._depth -= 1
+        self._buffer.append(char)
+
+    def _finish_field(self, value, events):
+        self.fields[self._key] = value
+        events.append(("field", self._key, value))
+        self.state = _SEEK_KEY
+
+
+def stream_completion(messages):
+    """Yields the text deltas of a streamed jamba-large chat completion."""
+    from ai21.models.chat import ChatMessage
+
+    client = providers.get_client('ai21')
+    # The slot is held until the whole stream has been read
+    with providers.slot('ai21'):
+        response = client.chat.completions.create(
+            model='jamba-large',
+            messages=[ChatMessage(role=message['role'], content=message['content']) for message in messages],
+            temperature=0.7,
+            stream=True
+            )
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+def stream_round(p1, p2, state, move_1, move_2, session=None):
+    """
+    Streams one LLM-resolved battle round
+
+    Yields the JsonFieldStream events as they are parsed, then a final
+    ("round", result) event where result holds the parsed round and the
+    players' HP after it.
+
+    With a battle_session.BattleSession the prompt is the session's prefix,
+    history and round delta, and p1, p2 and state are not used; the result
+    also has the round's token accounting.
+
+    Raises:
+        ValueError: If the response ended before the JSON object was complete
+    """
+    if session is not None:
+        messages = session.messages(move_1, move_2)
+    else:
+        messages = generate_battle_messages(p1, p2, state, move_1, move_2)
+
+    parser = JsonFieldStream()
+    for text in stream_completion(messages):
+        for event in parser.feed(text):
+            if event[0] != "done":
+                yield event
+        if parser.done:
+            break
+
+    if not parser.done:
+        raise ValueError("Response ended before the round JSON was complete")
+
+    round_json = validate_round(parser.fields)
+    if session is not None:
+        tokens = session.record(move_1, move_2, round_json)
+        hp_1, hp_2 = session.hp
+        yield "round", {**round_json, "hp_1": hp_1, "hp_2": hp_2, "both_alive": session.both_alive,
+                        "tokens": tokens}
+        return
+
+    p1, p2, state, both_alive = upd_players_and_state(dict(p1), dict(p2), round_json)
+    yield "round", {
+        **round_json,
+        "hp_1": p1['hp'],
+        "hp_2": p2['hp'],
+        "both_alive": both_alive,
+    }
@@ -0,0 +1,100 @@
+"""
+Explicit warm-up of the lazily loaded parts of the pipeline.
+
+Importing flask_app only loads Flask and the light modules; the stage
+modules (numpy, PIL, rembg, the provider SDKs), the provider clients and the
+rembg model load when their stage first runs. warm_up() loads them ahead of
+time instead, e.g. on a background thread right after the worker boots, so
+neither the boot nor the first request pays for them.
+"""
+
+import importlib
+import os
+import time
+
+from dotenv import load_dotenv
+
+import providers
+
+# Load environment variables
+load_dotenv()
+
+# Comma separated subset of STAGES run by warm_up()
+WARMUP_STAGES = [s.strip() for s in os.getenv("WARMUP_STAGES", "modules,clients,rembg,cpu_pool").split(",") if s.strip()]
+
+# Modules only needed once generation or a battle round runs
+STAGE_MODULES = (
+    "ai21.models.chat",
+    "openai",
+    "requests",
+    "numpy",
+    "PIL.Image",
+    "simulator",
+    "image_gen",
+    "bg_removal",
+    "cpu_pool",
+)
+
+
+def _import_modules():
+    for name in STAGE_MODULES:
+        importlib.import_module(name)
+
+
+def _create_clients():
+    for name, settings in providers.PROVIDERS.items():
+        if os.getenv(settings["api_key_env"]):
+            providers.get_client(name)
+    providers.http_session()
+
+
+def _load_rembg():
+    import bg_removal
+    import cpu_pool
+
+    # With a CPU pool the model is only used, and loaded, in the pool processes
+    if cpu_pool.CPU_WORKERS <= 0:
+        bg_removal.warm_up()
+
+
+def _start_cpu_pool():
+    import cpu_pool
+
+    cpu_pool.warm_up()
+
+
+STAGES = {
+    "modules": _import_modules,
+    "clients": _create_clients,
+    "rembg": _load_rembg,
+    "cpu_pool": _start_cpu_pool,
+}
+
+_status = {}
+
+
+def warm_up(stages=None):
+    """
+    Runs the warm-up stages in order, a failing stage does not stop the rest
+
+    Args:
+        stages (list): Stage names (default: WARMUP_STAGES)
+
+    Returns:
+        dict: stage -> seconds taken, or the error message
+    """
+    for stage in stages or WARMUP_STAGES:
+        start = time.perf_counter()
+        try:
+            STAGES[stage]()
+        except Exception as e:
+            print(f"Warm-up stage {stage} failed: {e}")
+            _status[stage] = {"error": str(e)}
+            continue
+        _status[stage] = {"seconds": round(time.perf_counter() - start, 3)}
+    return dict(_status)
+
+
+def status():
+    """Result of every warm-up stage that has run so far."""
+    return dict(_status)
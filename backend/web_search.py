@@ -1,7 +1,10 @@
 import json
 import os
-import requests
 from dotenv import load_dotenv
+from json_extract import extract_battle
+import requests
+import providers
+import resilience
 
 # Load environment variables
 load_dotenv()
@@ -78,6 +81,7 @@ def create_battle_query(topic="rappers in 2025"):
     
     return query
 
+@resilience.resilient("openai", name="openai.chat")
 def query_chatgpt(prompt):
     """
     Sends a query to the ChatGPT API and returns the response
@@ -103,14 +107,16 @@ def query_chatgpt(prompt):
         "max_tokens": 2000
     }
     
-    response = requests.post(
-        "https://api.openai.com/v1/chat/completions",
-        headers=headers,
-        json=data
-    )
+    with providers.slot("openai"):
+        response = providers.http_session().post(
+            "https://api.openai.com/v1/chat/completions",
+            headers=headers,
+            json=data,
+            timeout=providers.http_timeout()
+        )
     
     if response.status_code != 200:
-        raise Exception(f"Error: {response.status_code}, {response.text}")
+        raise requests.HTTPError(f"Error: {response.status_code}, {response.text}", response=response)
     
     return response.json()
 
@@ -121,27 +127,20 @@ def save_to_file(data, filename="battle.json"):
     # Extract the message content
     content = data['choices'][0]['message']['content']
     
-    # Try to find and parse the JSON part of the response
+    # Recover the battle JSON from the response and check it against the schema
     try:
-        # Look for JSON structure in the response
-        json_start = content.find('{')
-        json_end = content.rfind('}') + 1
-        
-        if json_start >= 0 and json_end > json_start:
-            json_str = content[json_start:json_end]
-            battle_data = json.loads(json_str)
-            
-            with open(filename, 'w') as f:
-                json.dump(battle_data, f, indent=4)
-            
-            print(f"Battle data saved to {filename}")
-        else:
-            raise ValueError("No JSON found in the response")
-            
-    except json.JSONDecodeError:
-        print("Could not parse JSON from response. Saving raw response.")
+        battle_data = extract_battle(content)
+    except ValueError as e:
+        print(f"Could not parse JSON from response ({e}). Saving raw response.")
         with open(filename, 'w') as f:
             f.write(content)
+        return None
+
+    with open(filename, 'w') as f:
+        json.dump(battle_data, f, separators=(',', ':'))
+
+    print(f"Battle data saved to {filename}")
+    return battle_data
 
 def main():
     """
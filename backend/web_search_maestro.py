@@ -1,17 +1,17 @@
-from ai21 import AI21Client
-import json
 import os
 from dotenv import load_dotenv
-import re
-from image_gen import main as image_gen_main
+from artifacts import atomic_write_json
+from battle_cache import get_cache as get_battle_cache
+from json_extract import extract_battle
+import metrics
+import providers
+import resilience
+import router
 
 # Load environment variables
 load_dotenv()
 
 
-client = AI21Client(api_key=os.getenv('AI21_API_KEY'))
-
-
 def create_battle_query(topic="rappers in 2025"):
     """
     Creates a query for ChatGPT to generate a battle simulation based on a given topic
@@ -30,11 +30,8 @@ Topic: {topic} """
     return query
 
 
-def query_maestro(prompt):
-    """
-    Sends a query to the ChatGPT API and returns the response
-    """
-    run_result = client.beta.maestro.runs.create_and_poll(
+def _run_maestro(client, prompt):
+    return client.beta.maestro.runs.create_and_poll(
         input=prompt,
         requirements=[
             {
@@ -106,61 +103,133 @@ def query_maestro(prompt):
             },
         ],
     )
-    print(type(run_result.result))
-    match = re.search(r"```json\s*(\{.*?\})\s*```",
-                      run_result.result, re.DOTALL)
-    if match:
-        json_str = match.group(1)
-        try:
-            data = json.loads(json_str)
-        except json.JSONDecodeError as e:
-            print("Error decoding JSON:", e)
-    else:
-        print("JSON block not found.")
 
-    return data
+
+# A Maestro run polls for minutes, so it is retried but never hedged
+@resilience.resilient("ai21", name="ai21.maestro", attempts=3, hedge=False)
+def query_maestro(prompt):
+    """
+    Sends a query to AI21 Maestro and returns the parsed battle
+    """
+    client = providers.get_client("ai21")
+    with metrics.span("maestro_run"), providers.slot("ai21_maestro"):
+        run_result = _run_maestro(client, prompt)
+    try:
+        with metrics.span("json_parse") as span:
+            span.set_size(len(run_result.result or ""))
+            return extract_battle(run_result.result)
+    except ValueError as e:
+        print("Error decoding JSON:", e)
+        raise
 
 
 def save_to_file(data, filename="rapper_battle.json"):
     """
     Saves the response to a JSON file
+
+    Raises:
+        OSError: If the file can't be written; the images are generated from
+            it, so the pipeline can't go on without it
     """
+    atomic_write_json(filename, data, separators=(",", ":"))
+    print(f"Battle data saved to {filename}")
 
-    # Try to find and parse the JSON part of the response
-    try:
 
-        with open(filename, 'w') as f:
-            json.dump(data, f, indent=4)
+def generate_battle(topic="rappers in 2025", on_stage=None, refresh=False, output_dir=None, images=True):
+    """
+    Runs the whole pipeline for a topic: battle generation, battle file and images
 
-        print(f"Battle data saved to {filename}")
+    The battle is generated by router, which races or falls back between
+    Maestro, ChatGPT and jamba. It is served from the battle cache when the
+    same topic was generated recently, unless refresh is set.
 
-    except json.JSONDecodeError:
-        print("Could not parse JSON from response. Saving raw response.")
+    Args:
+        topic (str): The topic for the battle simulation
+        on_stage (callable): Optional callback told the name of each stage as it starts
+        refresh (bool): Bypass the battle cache and generate a fresh battle
+        output_dir (str): Directory for battle.json and the images. Defaults to
+            ./battle.json and ./public, which concurrent runs would share.
+        images (bool): Generate the sprites, False stops after the battle file
 
-def main(topic="rappers in 2025"):
-    """
-    Main function to run the battle simulation query
+    Returns:
+        dict: The battle data, the generated image paths and the post-processed
+        sprites (see sprite_post.post_process)
     """
-    try:
-       
-        # Create the query with the specified topic
-        query = create_battle_query(topic)
+    report = on_stage or (lambda stage: None)
+    route = None
+
+    def run_router():
+        nonlocal route
+        # Send the query to the fastest healthy generation route(s)
+        report("query")
+        print("Generating battle...")
+        route, battle = router.generate(topic)
+        print(f"Battle generated by {route}")
+        return battle
+
+    response, cached = get_battle_cache().get_or_compute(topic, run_router, refresh=refresh)
+    if cached:
+        print(f"Using cached battle for {topic}")
+
+    # Simulate the matchup and even out lopsided ones before anything is saved
+    report("balance")
+    # The stage modules pull in numpy, PIL and rembg, so they are only
+    # imported once a battle gets this far (or by warmup)
+    from simulator import balance_battle
+
+    with metrics.span("balance"):
+        response, balance = balance_battle(response)
+    if balance is not None:
+        print(f"Win rates: {balance['win_rate_1']:.0%} / {balance['win_rate_2']:.0%}"
+              f"{' after rebalancing' if balance.get('rebalanced') else ''}")
+
+    # Save the response to a file
+    report("save")
+    if output_dir is not None:
+        filename = os.path.join(output_dir, "battle.json")
+        image_dir = output_dir
+    else:
+        filename = "battle.json"
+        image_dir = "./public"
+    save_to_file(response, filename)
 
-        # Send the query to ChatGPT
-        print("Sending query to Maestro...")
-        response = query_maestro(query)
+    # Print confirmation
+    print(f"{topic} battle data generated successfully!")
 
-        # Create a filename based on the topic
-        filename = "battle.json"
+    if not images:
+        return {"topic": topic, "battle": response, "cached": cached, "route": route, "balance": balance,
+                "battle_file": filename, "images": {}, "sprites": {}}
+
+    report("images")
+    from image_gen import main as image_gen_main
 
-        # Save the response to a file
-        save_to_file(response, filename)
+    with metrics.span("images"):
+        image_paths = image_gen_main(filename, output_dir=image_dir)
 
-        # Print confirmation
-        print(f"{topic} battle data generated successfully!")
+    # Small indexed sprites and the sprite sheet; the full-size images stay
+    # for clients that still load them
+    import cpu_pool
+    import sprite_post
 
-        image_gen_main(filename)
-        
+    sprites = {}
+    if sprite_post.SPRITE_POST and image_paths:
+        report("sprites")
+        with metrics.span("sprite_post"):
+            try:
+                sprites = cpu_pool.post_process(image_paths, image_dir)
+            except (OSError, ValueError) as e:
+                print(f"Sprite post-processing failed: {e}")
+
+    return {"topic": topic, "battle": response, "cached": cached, "route": route, "balance": balance,
+            "battle_file": filename, "images": image_paths, "sprites": sprites}
+
+
+def main(topic="rappers in 2025"):
+    """
+    Main function to run the battle simulation query
+    """
+    try:
+        generate_battle(topic)
     except Exception as e:
         print(f"Error: {e}")
 